@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Test the input FIFO relay of the dummy player (`Player._RELAY_SCRIPT`
+# in mp.py): over a simulated long session (many short-lived writers,
+# like `mp-control` invocations, with idle periods in between), all
+# commands must be relayed, without using CPU while idle.
+
+import argparse
+import ast
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+
+
+def get_relay_script(path):
+    ''' Extract the relay script from mp.py (without importing it, as it runs on import). '''
+    with open(path) as fp:
+        tree = ast.parse(fp.read(), path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ClassDef) and node.name == 'Player':
+            for stmt in node.body:
+                if isinstance(stmt, ast.Assign) and [t.id for t in stmt.targets] == ['_RELAY_SCRIPT']:
+                    return textwrap.dedent(stmt.value.args[0].value)
+    raise ValueError('no relay script found in %s' % path)
+
+def get_cpu_time(pid):
+    ''' Return the CPU time (user and system, in seconds) used by process `pid`. '''
+    with open('/proc/%u/stat' % pid) as fp:
+        fields = fp.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def send(fifo, cmd, timeout=10):
+    ''' Send a command like `Player._send_command`: one writer per command. '''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            # No reader (yet, or reopening).
+            if time.monotonic() > deadline:
+                raise ValueError('no reader for %s after %us' % (fifo, timeout))
+            time.sleep(0.001)
+            continue
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(cmd + '\n')
+        return
+
+def wait_for(received, count, timeout):
+    deadline = time.monotonic() + timeout
+    while len(received) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--mp',
+                    metavar='FILE', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mp.py'),
+                    help='mp script to extract the relay from (default: mp.py next to this script)')
+parser.add_argument('--commands',
+                    metavar='N', type=int, default=2000,
+                    help='number of commands to send (each with its own writer)')
+parser.add_argument('--burst',
+                    metavar='N', type=int, default=20,
+                    help='number of commands sent in a row, before pausing')
+parser.add_argument('--idle',
+                    metavar='SECONDS', type=float, default=3,
+                    help='duration of the idle period once all commands are sent')
+parser.add_argument('--max-command-cpu',
+                    metavar='SECONDS', type=float, default=0.002,
+                    help='maximum relay CPU time per command')
+parser.add_argument('--max-idle-cpu',
+                    metavar='SECONDS', type=float, default=0.05,
+                    help='maximum relay CPU time while idle')
+options = parser.parse_args()
+
+script = get_relay_script(options.mp)
+
+with tempfile.TemporaryDirectory() as directory:
+
+    fifo = os.path.join(directory, 'input')
+    os.mkfifo(fifo)
+    relay = subprocess.Popen([sys.executable, '-c', script, fifo], stdout=subprocess.PIPE)
+
+    errors = []
+    received = []
+    sent = []
+    session_cpu = session_time = startup_idle_cpu = idle_cpu = 0
+    def read():
+        for line in relay.stdout:
+            received.append(line.decode().rstrip('\n'))
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+
+    try:
+
+        # Idle before any writer.
+        start_cpu = get_cpu_time(relay.pid)
+        time.sleep(options.idle)
+        startup_idle_cpu = get_cpu_time(relay.pid) - start_cpu
+
+        # Session: bursts of commands, with short pauses.
+        start_cpu = get_cpu_time(relay.pid)
+        start = time.monotonic()
+        for n in range(options.commands):
+            cmd = 'command %u' % n
+            send(fifo, cmd)
+            sent.append(cmd)
+            if n % options.burst == options.burst - 1:
+                time.sleep(0.01)
+        wait_for(received, len(sent), timeout=10)
+        session_cpu = get_cpu_time(relay.pid) - start_cpu
+        session_time = time.monotonic() - start
+
+        # Idle after all writers closed the FIFO.
+        start_cpu = get_cpu_time(relay.pid)
+        time.sleep(options.idle)
+        idle_cpu = get_cpu_time(relay.pid) - start_cpu
+
+    except ValueError as e:
+        errors.append(str(e))
+
+    finally:
+        relay.kill()
+        relay.wait()
+
+if received != sent:
+    missing = len(set(sent) - set(received))
+    errors.append('%u commands sent, %u received (%u missing)' % (len(sent), len(received), missing))
+if session_cpu > options.max_command_cpu * len(sent):
+    errors.append('relay CPU time for %u commands: %.3fs (maximum %.3fs)' % (
+        len(sent), session_cpu, options.max_command_cpu * len(sent)))
+for name, cpu in (('before any writer', startup_idle_cpu), ('after all writers closed', idle_cpu)):
+    if cpu > options.max_idle_cpu:
+        errors.append('relay CPU time while idle %s: %.3fs over %.1fs (maximum %.3fs)' % (
+            name, cpu, options.idle, options.max_idle_cpu))
+
+print('%u commands relayed in %.1fs, CPU time: %.3fs (session), %.3fs + %.3fs (idle %.1fs)' % (
+    len(received), session_time, session_cpu, startup_idle_cpu, idle_cpu, options.idle))
+for error in errors:
+    print('FAILED: %s' % error, file=sys.stderr)
+sys.exit(1 if errors else 0)
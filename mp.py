@@ -1,24 +1,30 @@
 #!/usr/bin/env python3
 
 __requires__ = '''
+numpy >= 1.20.0
 pycountry >= 18.2.23
 xattr >= 0.9.3
 '''
 
+# Note: to keep startup fast (especially for `mp-control`), heavier
+# modules (asyncio, sqlite3, subprocess, pycountry, ...) are only
+# imported by the code needing them.
 import argparse
-import configparser
+import collections
+import contextlib
+import errno
+import functools
 import json
-import mimetypes
 import os
-import pprint
-import re
+import select
 import shlex
-import subprocess
+import signal
+import socket
+import struct
 import sys
 import textwrap
-
-from pycountry import languages
-from xattr import xattr
+import threading
+import time
 
 
 MP_PROG = os.path.basename(sys.argv[0])
@@ -39,25 +45,502 @@ def unlink_if_exists(file):
         os.unlink(file)
 
 
-class LoudnessDatabase(object):
+class Timings(object):
+    ''' Record the duration of stages (optionally per file), and the
+    number of subprocesses started, for `--timings`.
+
+    Stages can be repeated: their durations add up (including when run
+    in parallel). Recording is cheap, so always done.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Stage -> [duration, count], in first use order.
+        self._stages = {}
+        # File -> stage -> duration.
+        self._files = {}
+        # Program -> count.
+        self._subprocesses = {}
+        # Interpreter startup and module imports
+        # (/proc start time has a clock tick resolution).
+        with open('/proc/self/stat') as fp:
+            start_ticks = int(fp.read().rsplit(')', 1)[1].split()[19])
+        self._process_start = start_ticks / os.sysconf('SC_CLK_TCK')
+        self.mark('startup')
+
+    def add(self, name, duration, file=None):
+        with self._lock:
+            stage = self._stages.setdefault(name, [0, 0])
+            stage[0] += duration
+            stage[1] += 1
+            if file is not None:
+                stages = self._files.setdefault(file, {})
+                stages[name] = stages.get(name, 0) + duration
+
+    @contextlib.contextmanager
+    def stage(self, name, file=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start, file)
+
+    def mark(self, name):
+        ''' Record the time elapsed since the process started. '''
+        self.add(name, time.clock_gettime(time.CLOCK_BOOTTIME) - self._process_start)
+
+    def count_subprocess(self, cmd):
+        prog = os.path.basename(cmd[0])
+        with self._lock:
+            self._subprocesses[prog] = self._subprocesses.get(prog, 0) + 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'stages': {name: {'duration': duration, 'count': count}
+                           for name, (duration, count) in self._stages.items()},
+                'files': {fname: dict(stages) for fname, stages in self._files.items()},
+                'subprocesses': dict(self._subprocesses),
+            }
+
+    def report(self, json_file=None):
+        ''' Print a summary, and append the details to `json_file` (as JSON, one line per run). '''
+        timings = self.as_dict()
+        msg('timings:')
+        for name, stage in timings['stages'].items():
+            line = '  %-24s %8.3fs' % (name, stage['duration'])
+            if stage['count'] > 1:
+                line += ' (%u times)' % stage['count']
+            msg(line)
+        if timings['subprocesses']:
+            msg('subprocesses: %s' % ', '.join(
+                '%s %u' % item for item in sorted(timings['subprocesses'].items())))
+        if json_file is not None:
+            timings['prog'] = MP_PROG
+            timings['time'] = time.time()
+            with open(json_file, 'a') as fp:
+                fp.write(json.dumps(timings) + '\n')
+
+
+TIMINGS = Timings()
+
+
+def opensubtitles_hash(path):
+    ''' Compute the OpenSubtitles hash of a file: its size plus the sum
+    of its first and last 64KiB, as 64-bit little-endian integers. '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        head = os.pread(fd, 65536, 0)
+        tail = os.pread(fd, 65536, max(0, size - 65536))
+    finally:
+        os.close(fd)
+    value = size
+    for chunk in (head, tail):
+        chunk += b'\0' * (-len(chunk) % 8)
+        value += sum(struct.unpack('<%uQ' % (len(chunk) // 8), chunk))
+    return '%016x' % (value & 0xffffffffffffffff)
+
+
+class SqliteDatabase(object):
+    ''' SQLite database, with the connection shared by threads.
+
+    The database is used as a cache: on schema change,
+    the tables are simply recreated.
+    '''
+
+    SCHEMA_VERSION = None
+
+    # Sequence of `(table, create statement)` tuples.
+    _SCHEMA = ()
+
+    def __init__(self, path):
+        import sqlite3
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # The connection is shared with worker threads, serialize accesses.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            version = self._db.execute('PRAGMA user_version').fetchone()[0]
+            if version != self.SCHEMA_VERSION:
+                for table, create in self._SCHEMA:
+                    self._db.execute('DROP TABLE IF EXISTS %s' % table)
+                    self._db.execute(create)
+                self._db.execute('PRAGMA user_version = %u' % self.SCHEMA_VERSION)
+
+
+class SubtitlesMisses(SqliteDatabase):
+    ''' Record of subtitles downloaders failing to find subtitles for a file.
+
+    After a failure, the same downloader is not tried again for the same
+    file and language for `delay` seconds, with the delay multiplied by
+    `backoff` after each new failure.
+    '''
+
+    SCHEMA_VERSION = 1
+
+    _SCHEMA = (
+        ('misses', '''
+         CREATE TABLE misses (
+             hash TEXT, downloader TEXT, language TEXT,
+             failures INTEGER, retry REAL,
+             PRIMARY KEY (hash, downloader, language)
+         )
+         '''),
+    )
+
+    # Maximum delay before retrying (in seconds).
+    MAX_DELAY = 90 * 24 * 3600
+
+    def __init__(self, path, delay, backoff):
+        super().__init__(path)
+        self._delay = delay
+        self._backoff = backoff
+
+    def get_misses(self, hash, language):
+        ''' Return the set of downloaders not to retry yet. '''
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT downloader FROM misses WHERE hash = ? AND language = ? AND retry > ?',
+                (hash, language, time.time()),
+            ).fetchall()
+        return set(downloader for downloader, in rows)
+
+    def add_miss(self, hash, downloader, language):
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT failures FROM misses WHERE hash = ? AND downloader = ? AND language = ?',
+                (hash, downloader, language),
+            ).fetchone()
+            failures = 1 if row is None else row[0] + 1
+            delay = min(self._delay * self._backoff ** (failures - 1), self.MAX_DELAY)
+            self._db.execute(
+                'INSERT OR REPLACE INTO misses VALUES (?, ?, ?, ?, ?)',
+                (hash, downloader, language, failures, time.time() + delay),
+            )
+
+    def clear_misses(self, hash, language):
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM misses WHERE hash = ? AND language = ?',
+                (hash, language),
+            )
+
+
+class AttributesIndex(SqliteDatabase):
+    ''' On-disk index of file attributes.
+
+    Used as a fallback for files on filesystems without (writable)
+    extended attributes support. Entries are keyed on the file device,
+    inode, size and modification time, so they are ignored as soon as
+    the file is modified.
+    '''
+
+    SCHEMA_VERSION = 1
+
+    _SCHEMA = (
+        ('attributes', '''
+         CREATE TABLE attributes (
+             dev INTEGER, ino INTEGER,
+             size INTEGER, mtime INTEGER,
+             name TEXT, value BLOB,
+             PRIMARY KEY (dev, ino, name)
+         )
+         '''),
+    )
+
+    # Maximum number of files per lookup query.
+    _QUERY_SIZE = 500
+
+    def get(self, path, name, exact=True):
+        return self.get_many([path], name, exact=exact).get(path)
+
+    def get_many(self, paths, name, exact=True):
+        ''' Lookup attribute `name` for all `paths` at once.
+
+        Return a dictionary mapping each path with a valid entry to its value.
+        If `exact` is false, entries for a previous version of a file (same
+        inode, but different size or modification time) are returned too.
+        '''
+        files = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.setdefault((st.st_dev, st.st_ino), []).append(
+                (path, st.st_size, st.st_mtime_ns)
+            )
+        # Device -> inodes: queried by device, so the
+        # primary key index can be used for the lookups.
+        devices = {}
+        for dev, ino in files:
+            devices.setdefault(dev, []).append(ino)
+        values = {}
+        for dev, inodes in sorted(devices.items()):
+            inodes.sort()
+            for n in range(0, len(inodes), self._QUERY_SIZE):
+                chunk = inodes[n:n+self._QUERY_SIZE]
+                query = (
+                    'SELECT ino, size, mtime, value FROM attributes '
+                    'WHERE dev = ? AND ino IN (%s) AND name = ?' % ', '.join('?' * len(chunk))
+                )
+                with self._lock:
+                    rows = self._db.execute(query, [dev] + chunk + [name]).fetchall()
+                for ino, size, mtime, value in rows:
+                    for path, st_size, st_mtime in files[(dev, ino)]:
+                        if not exact or (size, mtime) == (st_size, st_mtime):
+                            values[path] = value
+        return values
+
+    def set(self, path, name, value):
+        st = os.stat(path)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO attributes VALUES (?, ?, ?, ?, ?, ?)',
+                (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, name, value),
+            )
+
+
+class AttributeCache(object):
+    ''' Cached information about files.
+
+    Stored in an extended attribute, or in the index when extended
+    attributes are not available.
+    '''
+
+    FATTR = None
+
+    def __init__(self, index=None):
+        self._index = index
+        self._prefetched = {}
+
+    def prefetch(self, paths):
+        ''' Lookup index entries for all `paths` in one go.
+
+        Entries for a previous version of a file are fetched too (like
+        `check` needs), stale values being skipped when decoded anyway.
+        '''
+        if self._index is None:
+            return
+        values = self._index.get_many(paths, self.FATTR, exact=False)
+        for path in paths:
+            self._prefetched[path] = values.get(path)
+
+    def _get_values(self, path, exact=True):
+        ''' Yield the cached values of a file: from its extended attribute,
+        then from the index.
+
+        Note: the index is also used when the extended attribute is stale,
+        as it holds the new value when updating the attribute failed (e.g.
+        read-only filesystem, or file owned by another user).
+        '''
+        from xattr import xattr
+        try:
+            yield xattr(path)[self.FATTR]
+        except KeyError:
+            pass
+        if self._index is None:
+            return
+        if path in self._prefetched:
+            value = self._prefetched[path]
+        else:
+            value = self._index.get(path, self.FATTR, exact=exact)
+        if value is not None:
+            yield value
+
+    def _decode_values(self, values, st):
+        ''' Yield the decoded `values`, skipping stale (or invalid) ones. '''
+        for value in values:
+            try:
+                value = self._decode(value, st)
+            except ValueError:
+                value = None
+            if value is not None:
+                yield value
+
+    def _get_cached(self, path, st):
+        ''' Return the decoded cached value of a file, or `None` if there's
+        no up-to-date (and acceptable) one. '''
+        for value in self._decode_values(self._get_values(path), st):
+            if self._is_acceptable(value):
+                return value
+        return None
+
+    def _set_value(self, path, value):
+        from xattr import xattr
+        try:
+            xattr(path)[self.FATTR] = value
+        except OSError:
+            # No extended attributes support (or read-only filesystem).
+            if self._index is None:
+                raise
+            self._index.set(path, self.FATTR, value)
+        self._prefetched.pop(path, None)
+
+    def _decode(self, value, st):
+        ''' Decode a cached value, return `None` if it is stale. '''
+        raise NotImplementedError()
+
+    def _is_acceptable(self, value):
+        ''' Can the (decoded) cached value be used? '''
+        return True
+
+    def check(self, path):
+        ''' Check the cached information of a file.
+
+        Return one of `'missing'`, `'stale'`, `'approximate'` (up-to-date,
+        but not acceptable, see `_is_acceptable`), or `'ok'`.
+        '''
+        st = os.stat(path)
+        values = list(self._get_values(path, exact=False))
+        if not values:
+            return 'missing'
+        values = list(self._decode_values(values, st))
+        if not values:
+            return 'stale'
+        if not any(self._is_acceptable(value) for value in values):
+            return 'approximate'
+        return 'ok'
+
+
+class StreamsDatabase(AttributeCache):
+    ''' Cached list of the streams of a file: codec type and language. '''
+
+    FATTR = 'user.streams'
+
+    def _encode(self, streams, st):
+        return b'%u %u %s' % (
+            st.st_size, st.st_mtime_ns,
+            json.dumps(streams, separators=(',', ':')).encode(),
+        )
+
+    def _decode(self, value, st):
+        size, mtime, streams = value.split(b' ', 2)
+        if (int(size), int(mtime)) != (st.st_size, st.st_mtime_ns):
+            return None
+        return json.loads(streams.decode())
+
+    def _probe(self, path):
+        import subprocess
+        cmd = (
+            'ffprobe', '-loglevel', 'warning',
+            '-show_streams', '-print_format', 'json', path,
+        )
+        TIMINGS.count_subprocess(cmd)
+        try:
+            with TIMINGS.stage('ffprobe', path):
+                info = json.loads(subprocess.run(cmd, stdout=subprocess.PIPE).stdout)
+        except Exception as e:
+            msg(e)
+            return None
+        streams = []
+        for stream in info.get('streams', ()):
+            tags = stream.get('tags', {})
+            streams.append({
+                'codec_type': stream.get('codec_type'),
+                'language': tags.get('language') or tags.get('LANGUAGE'),
+            })
+        return streams
+
+    def get_streams(self, path):
+        ''' Return the list of streams of a file, or `None` on error. '''
+        st = os.stat(path)
+        streams = self._get_cached(path, st)
+        if streams is not None:
+            return streams
+        streams = self._probe(path)
+        if streams is not None:
+            self._set_value(path, self._encode(streams, st))
+        return streams
+
+
+class HashDatabase(AttributeCache):
+    ''' Cached OpenSubtitles hash of files. '''
+
+    FATTR = 'user.oshash'
+
+    def _encode(self, hash, st):
+        return b'%u %u %s' % (st.st_size, st.st_mtime_ns, hash.encode())
+
+    def _decode(self, value, st):
+        size, mtime, hash = value.split()
+        if (int(size), int(mtime)) != (st.st_size, st.st_mtime_ns):
+            return None
+        return hash.decode()
+
+    def get_hash(self, path):
+        st = os.stat(path)
+        hash = self._get_cached(path, st)
+        if hash is not None:
+            return hash
+        hash = opensubtitles_hash(path)
+        self._set_value(path, self._encode(hash, st))
+        return hash
+
+
+class LoudnessDatabase(AttributeCache):
 
     FATTR = 'user.loudness'
     NULL = open(os.devnull, 'r+b')
 
-    def __init__(self, midvol, maxvol):
+    # Bump when the way loudness is calculated changes,
+    # so existing entries get automatically rescanned.
+    SCANNER_VERSION = 2
+
+    MODES = ('full', 'fast')
+
+    # Duration (in seconds) of each window decoded in fast mode.
+    FAST_WINDOW = 15
+
+    def __init__(self, midvol, maxvol, index=None, mode='full', windows=10):
+        assert mode in self.MODES
+        super().__init__(index=index)
         self._midvol = float(midvol)
         self._maxvol = float(maxvol)
+        self._mode = mode
+        self._windows = windows
+
+    def _encode(self, lufs, peak, mode, st):
+        return b'%f %f %u %u %u %s' % (
+            lufs, peak, st.st_size, st.st_mtime_ns,
+            self.SCANNER_VERSION, mode.encode(),
+        )
+
+    def _decode(self, value, st):
+        ''' Decode a cached value.
+
+        Return a `(lufs, peak, mode)` tuple, or `None` if it is stale.
+        '''
+        fields = value.split()
+        # Note: entries from older versions only contain the loudness and peak,
+        # and do not record the mode (always a full scan).
+        if len(fields) == 5:
+            fields.append(b'full')
+        if len(fields) != 6:
+            return None
+        lufs, peak = float(fields[0]), float(fields[1])
+        size, mtime, version = [int(f) for f in fields[2:5]]
+        if (size, mtime, version) != (st.st_size, st.st_mtime_ns, self.SCANNER_VERSION):
+            return None
+        return lufs, peak, fields[5].decode()
+
+    def _is_acceptable(self, loudness):
+        ''' Can an entry be used? Not if calculated in fast mode, when using full mode. '''
+        return self._mode == 'fast' or loudness[2] == 'full'
 
     def get_loudness(self, path):
-        fattrs = xattr(path)
-        if self.FATTR in fattrs:
-            lufs, peak = [float(v) for v in fattrs[self.FATTR].split()]
-            return lufs, peak
-        lufs, peak = self._calculate_loudness(path)
+        st = os.stat(path)
+        loudness = self._get_cached(path, st)
+        if loudness is not None:
+            return loudness[:2]
+        with TIMINGS.stage('loudness scan', path):
+            lufs, peak, mode = self._calculate_loudness(path)
         if lufs is None:
             return None, None
-        value = b'%f %f' % (lufs, peak)
-        fattrs[self.FATTR] = value
+        self._set_value(path, self._encode(lufs, peak, mode, st))
         return lufs, peak
 
     def get_volume(self, path):
@@ -66,19 +549,588 @@ class LoudnessDatabase(object):
             return None
         return 100 * 10 ** ((self._midvol + min(self._maxvol-lufs, -peak)) / 60)
 
-    def _calculate_loudness(self, path):
-        output = subprocess.check_output(
-            'loudness --force-plugin=ffmpeg scan -p dbtp'.split() +
-            [path], stderr=self.NULL,
+    def get_volumes(self, paths, jobs=None):
+        ''' Calculate the volume of several files using a pool of `jobs` workers.
+
+        Yield `(path, volume)` tuples as each file is done.
+        '''
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(self.get_volume, path): path for path in paths}
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+
+    def _get_duration(self, path):
+        import subprocess
+        cmd = (
+            'ffprobe', '-loglevel', 'error',
+            '-show_entries', 'format=duration',
+            '-print_format', 'csv=p=0', path,
         )
-        last_line = output.decode().strip().split('\n')[-1]
-        m = re.match(r'^\s*(-?[0-9.]+) LUFS,\s*(-?[0-9.]+) dBTP$', last_line)
-        if m is None:
-            if re.match(r'\s*-inf LUFS,\s*-inf dBTP$', last_line) is not None:
-                return 0, 0
-            return None, None
-        lufs, peak = float(m.group(1)), float(m.group(2))
-        return lufs, peak
+        TIMINGS.count_subprocess(cmd)
+        try:
+            with TIMINGS.stage('ffprobe', path):
+                output = subprocess.check_output(cmd, stderr=self.NULL)
+            return float(output)
+        except (subprocess.CalledProcessError, ValueError):
+            return None
+
+    def _calculate_loudness(self, path, mode=None):
+        ''' Calculate the loudness of a file.
+
+        In fast mode, only a number of evenly spaced windows are decoded.
+
+        Return a `(lufs, peak, mode)` tuple, where `mode` is the mode
+        effectively used (short files are always fully scanned).
+        '''
+        import subprocess
+        if mode is None:
+            mode = self._mode
+        windows = [(None, None)]
+        if mode == 'fast':
+            duration = self._get_duration(path)
+            window = self.FAST_WINDOW
+            if duration is not None and duration > self._windows * window:
+                step = duration / self._windows
+                windows = [
+                    (step * (n + .5) - window / 2, window)
+                    for n in range(self._windows)
+                ]
+            else:
+                mode = 'full'
+        meter = None
+        for start, length in windows:
+            cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error']
+            if start is not None:
+                cmd.extend(('-ss', '%.3f' % start, '-t', '%.3f' % length))
+            cmd.extend((
+                '-i', path, '-map', '0:a:0',
+                '-ar', str(LoudnessMeter.RATE),
+                '-c:a', 'pcm_f32le', '-f', 'wav', '-',
+            ))
+            TIMINGS.count_subprocess(cmd)
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=self.NULL) as proc:
+                try:
+                    weights = LoudnessMeter.read_wav_header(proc.stdout)
+                except ValueError:
+                    # No audio stream, or decoding error.
+                    proc.kill()
+                    return None, None, mode
+                if meter is None:
+                    meter = LoudnessMeter(weights)
+                else:
+                    meter.split()
+                meter.feed_stream(proc.stdout)
+            if proc.returncode != 0:
+                return None, None, mode
+        lufs, peak = meter.result()
+        if lufs == float('-inf'):
+            if peak == float('-inf'):
+                # Digital silence.
+                return 0, 0, mode
+            return None, None, mode
+        return lufs, peak, mode
+
+
+class LoudnessMeter(object):
+    ''' EBU R128 integrated loudness and true-peak meter (ITU-R BS.1770-4).
+
+    Audio must be fed as 48kHz floating point frames.
+    '''
+
+    RATE = 48000
+
+    # K-weighting filter (pre-filter and RLB high-pass) coefficients at 48kHz.
+    _K_FILTERS = (
+        ((1.53512485958697, -2.69169618940638, 1.19839281085285),
+         (1.0, -1.69065929318241, 0.73248077421585)),
+        ((1.0, -2.0, 1.0),
+         (1.0, -1.99004745483398, 0.99007225036621)),
+    )
+    # The K-weighting is applied as a (FFT) convolution with its impulse
+    # response, truncated to this length (the tail is below 1e-15).
+    _K_TAPS = 8192
+
+    # Gating blocks are made of 4 segments of 100ms (75% overlap).
+    _SEGMENT = RATE // 10
+    # Frames processed at once.
+    _CHUNK = 48 * _SEGMENT
+
+    # True-peak: oversampling factor and interpolation filter length.
+    _TP_FACTOR = 4
+    _TP_TAPS = 48
+
+    # Channel mask bits of surround channels (weighted higher), and of LFE
+    # (ignored), see WAVE_FORMAT_EXTENSIBLE.
+    _SURROUND_CHANNELS = 0x10 | 0x20 | 0x100 | 0x200 | 0x400
+    _LFE_CHANNEL = 0x8
+
+    _k_response = None
+    _tp_phases = None
+    _tp_gain = None
+
+    def __init__(self, weights):
+        import numpy as np
+        cls = type(self)
+        if cls._k_response is None:
+            cls._k_response = cls._calculate_k_response()
+            cls._tp_phases = cls._calculate_tp_phases()
+            # Maximum gain of the interpolation filter.
+            cls._tp_gain = np.abs(cls._tp_phases).sum(axis=1).max()
+        channels = len(weights)
+        self._weights = np.array(weights, dtype=np.float64)
+        self._nfft = 1 << (self._CHUNK + self._K_TAPS - 2).bit_length()
+        self._k_spectrum = np.fft.rfft(self._k_response, self._nfft)
+        self._k_tail = np.zeros((channels, self._K_TAPS - 1))
+        self._tp_history = np.zeros((channels, self._tp_phases.shape[1] - 1))
+        self._runs = [[]]
+        self._peak = 0.0
+
+    @classmethod
+    def read_wav_header(cls, fp):
+        ''' Read the header of the WAV stream `fp`, return the channel weights. '''
+        header = fp.read(12)
+        if len(header) != 12 or header[:4] != b'RIFF' or header[8:] != b'WAVE':
+            raise ValueError('invalid WAV header')
+        weights = None
+        while True:
+            chunk = fp.read(8)
+            if len(chunk) != 8:
+                raise ValueError('truncated WAV header')
+            chunk_id, size = struct.unpack('<4sI', chunk)
+            if chunk_id == b'data':
+                break
+            data = fp.read(size + (size & 1))
+            if chunk_id != b'fmt ':
+                continue
+            tag, channels = struct.unpack('<HH', data[:4])
+            mask = 0
+            if tag == 0xfffe and size >= 24:
+                mask, = struct.unpack('<I', data[20:24])
+            weights = []
+            bit = 1
+            while len(weights) < channels:
+                if not mask & ~(bit - 1):
+                    weights.append(1.0)
+                    continue
+                if mask & bit:
+                    if bit & cls._LFE_CHANNEL:
+                        weights.append(0.0)
+                    elif bit & cls._SURROUND_CHANNELS:
+                        weights.append(1.41)
+                    else:
+                        weights.append(1.0)
+                bit <<= 1
+        if weights is None:
+            raise ValueError('missing WAV format')
+        return weights
+
+    @classmethod
+    def _calculate_k_response(cls):
+        import numpy as np
+        response = [0.0] * cls._K_TAPS
+        response[0] = 1.0
+        for b, a in cls._K_FILTERS:
+            x1 = x2 = y1 = y2 = 0.0
+            for n, x0 in enumerate(response):
+                y0 = b[0] * x0 + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+                x1, x2, y1, y2 = x0, x1, y0, y1
+                response[n] = y0
+        return np.array(response)
+
+    @classmethod
+    def _calculate_tp_phases(cls):
+        ''' Windowed-sinc interpolation filter, split in polyphase components. '''
+        import numpy as np
+        n = np.arange(cls._TP_TAPS) - (cls._TP_TAPS - 1) / 2
+        h = np.sinc(n / cls._TP_FACTOR) * np.kaiser(cls._TP_TAPS, 8.0)
+        phases = h.reshape(-1, cls._TP_FACTOR).T
+        # Normalize each phase for unity gain at DC,
+        # and reverse it (for use as a correlation).
+        phases = phases / phases.sum(axis=1, keepdims=True)
+        return phases[:, ::-1].copy()
+
+    def split(self):
+        ''' Start a new, discontinuous, run of frames.
+
+        Filters are reset, and no gating block will span both runs.
+        '''
+        self._k_tail[:] = 0
+        self._tp_history[:] = 0
+        self._runs.append([])
+
+    def feed_stream(self, fp):
+        ''' Feed all frames from the raw float32 stream `fp`. '''
+        import numpy as np
+        channels = len(self._weights)
+        frame_size = 4 * channels
+        while True:
+            data = fp.read(self._CHUNK * frame_size)
+            if not data:
+                break
+            data = data[:len(data) - len(data) % frame_size]
+            self.feed(np.frombuffer(data, dtype='<f4').reshape(-1, channels))
+
+    def feed(self, frames):
+        ''' Process `frames`, a (frames, channels) array.
+
+        Note: all frames must be passed in chunks of `_CHUNK`
+        frames, except for the last ones.
+        '''
+        import numpy as np
+        # Note: work on a (channels, frames) array for faster processing.
+        frames = frames.T.astype(np.float64)
+        count = frames.shape[1]
+        # True-peak: maximum of the oversampled signal. Only interpolate
+        # around frames loud enough to possibly exceed the current peak.
+        self._peak = max(self._peak, np.abs(frames).max(initial=0.0))
+        history = np.concatenate((self._tp_history, frames), axis=1)
+        self._tp_history = history[:, count:]
+        taps = self._tp_phases.shape[1]
+        loud = np.abs(history).max(axis=0) * self._tp_gain > self._peak
+        loud = np.convolve(loud, np.ones(taps), 'valid') > 0
+        if loud.any():
+            windows = np.lib.stride_tricks.sliding_window_view(history, taps, axis=1)
+            oversampled = windows[:, loud] @ self._tp_phases.T
+            self._peak = max(self._peak, np.abs(oversampled).max())
+        # K-weighting, using overlap-add.
+        spectrum = np.fft.rfft(frames, self._nfft) * self._k_spectrum
+        weighted = np.fft.irfft(spectrum, self._nfft)[:, :count + self._K_TAPS - 1]
+        weighted[:, :self._K_TAPS - 1] += self._k_tail
+        self._k_tail = weighted[:, count:].copy()
+        # Mean square of each complete segment.
+        segments = count // self._SEGMENT
+        weighted = weighted[:, :segments * self._SEGMENT]
+        weighted = weighted.reshape(len(weighted), segments, self._SEGMENT)
+        self._runs[-1].append((weighted ** 2).mean(axis=2).T)
+
+    def result(self):
+        ''' Return the integrated loudness (LUFS) and true peak (dBTP). '''
+        import numpy as np
+        with np.errstate(divide='ignore'):
+            peak = 20 * np.log10(self._peak)
+            # Overlapping gating blocks of 400ms.
+            blocks = [np.zeros((0, len(self._weights)))]
+            for run in self._runs:
+                if not run:
+                    continue
+                segments = np.concatenate(run)
+                blocks.append((segments[:-3] + segments[1:-2] + segments[2:-1] + segments[3:]) / 4)
+            blocks = np.concatenate(blocks)
+            loudness = -0.691 + 10 * np.log10(blocks @ self._weights)
+            # Absolute gating.
+            gated = loudness > -70
+            if not gated.any():
+                return float('-inf'), float(peak)
+            # Relative gating.
+            threshold = -0.691 + 10 * np.log10(blocks[gated].mean(axis=0) @ self._weights) - 10
+            gated &= loudness > threshold
+            lufs = -0.691 + 10 * np.log10(blocks[gated].mean(axis=0) @ self._weights)
+        return float(lufs), float(peak)
+
+
+def open_attributes_index():
+    return AttributesIndex(os.path.join(MP_DIR, 'loudness.db'))
+
+
+def open_loudness_database(options):
+    return LoudnessDatabase(-23, -13, index=open_attributes_index(),
+                            mode=options.loudness_mode,
+                            windows=options.loudness_windows)
+
+
+def open_streams_database():
+    return StreamsDatabase(index=open_attributes_index())
+
+
+def open_hash_database():
+    return HashDatabase(index=open_attributes_index())
+
+
+def open_subtitles_misses(options):
+    return SubtitlesMisses(os.path.join(MP_DIR, 'subtitles.db'),
+                           delay=options.subtitles_retry_delay * 3600,
+                           backoff=options.subtitles_retry_backoff)
+
+
+# Extension -> media type (e.g. 'video' for '.mkv'), see `get_media_type`.
+_MEDIA_TYPES = None
+
+# (offset, magic bytes, media type), see `sniff_media_type`.
+_MEDIA_MAGICS = (
+    (0, b'\x1a\x45\xdf\xa3', 'video'),  # Matroska / WebM
+    (4, b'ftypM4A ', 'audio'),
+    (4, b'ftyp', 'video'),  # MP4 / QuickTime
+    (8, b'AVI ', 'video'),
+    (8, b'WAVE', 'audio'),
+    (0, b'\x00\x00\x01\xba', 'video'),  # MPEG program stream
+    (0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11', 'video'),  # ASF / WMV
+    (0, b'FLV', 'video'),
+    (0, b'fLaC', 'audio'),
+    (0, b'ID3', 'audio'),  # MP3
+    (0, b'OggS', 'audio'),
+)
+
+
+def get_media_type(path, sniff=False):
+    ''' Return the media type of a file ('video', 'audio', ...)
+    based on its extension, or None if unknown.
+
+    If `sniff` is true, files without an extension are identified
+    by their content instead (see `sniff_media_type`).
+    '''
+    global _MEDIA_TYPES
+    if _MEDIA_TYPES is None:
+        import mimetypes
+        with TIMINGS.stage('mimetypes'):
+            mimetypes.init()
+            _MEDIA_TYPES = {
+                ext: mtype.split('/')[0]
+                for ext, mtype in mimetypes.types_map.items()
+            }
+    __, ext = os.path.splitext(path)
+    if ext:
+        return _MEDIA_TYPES.get(ext) or _MEDIA_TYPES.get(ext.lower())
+    if sniff:
+        return sniff_media_type(path)
+    return None
+
+
+def sniff_media_type(path):
+    ''' Identify the media type of a file using its first bytes. '''
+    try:
+        with open(path, 'rb') as fp:
+            head = fp.read(512)
+    except OSError:
+        return None
+    for offset, magic, media_type in _MEDIA_MAGICS:
+        if head[offset:offset + len(magic)] == magic:
+            if magic == b'OggS' and b'theora' in head:
+                return 'video'
+            return media_type
+    # MPEG transport stream: 188 bytes packets, starting with a sync byte.
+    if len(head) > 376 and head[0] == head[188] == head[376] == 0x47:
+        return 'video'
+    return None
+
+
+class PathRules(object):
+    ''' Directory rules: each rule includes a directory (and everything
+    below it), or excludes it when prefixed by `!`. The longest (most
+    specific) matching rule applies, nothing is included by default.
+
+    Rules are compiled into a trie of path components, so matching is
+    O(path depth), whatever the number of rules.
+    '''
+
+    def __init__(self, rules):
+        # Component -> node; the `None` key holds the rule of the node.
+        self._root = {}
+        for rule in rules:
+            include = not rule.startswith('!')
+            node = self._root
+            for part in self._split(rule if include else rule[1:]):
+                node = node.setdefault(part, {})
+            # Note: for duplicate rules, the first one wins.
+            node.setdefault(None, include)
+
+    @staticmethod
+    def _split(path):
+        parts = [part for part in path.split('/') if part]
+        if path.startswith('/'):
+            parts.insert(0, '')
+        return parts
+
+    def match(self, path):
+        ''' Is the directory `path` included? '''
+        node = self._root
+        included = node.get(None, False)
+        for part in self._split(path):
+            node = node.get(part)
+            if node is None:
+                break
+            included = node.get(None, included)
+        return included
+
+
+def walk_files(paths):
+    ''' Recursively list all the files in `paths`. '''
+    for path in paths:
+        if not os.path.isdir(path):
+            if os.path.isfile(path):
+                yield path
+            continue
+        directories = [path]
+        while directories:
+            directory = directories.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                msg(e)
+                continue
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
+
+
+def loudness_verify(options):
+    ''' Check the cached loudness of all files in `options.paths`,
+    reporting (and optionally repairing) stale entries. '''
+    import concurrent.futures
+    db = open_loudness_database(options)
+
+    def verify(path):
+        try:
+            status = db.check(path)
+            if status in ('stale', 'approximate') and options.repair:
+                db.get_loudness(path)
+                status = 'repaired'
+        except Exception as e:
+            # E.g. file removed since the walk.
+            msg('%s: %s' % (path, e))
+            status = 'failed'
+        return status
+
+    counts = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.scan_jobs) as executor:
+        files = list(walk_files(options.paths))
+        for path, status in zip(files, executor.map(verify, files)):
+            counts[status] = counts.get(status, 0) + 1
+            if status in ('stale', 'approximate', 'repaired', 'failed'):
+                print('%s: %s' % (status, path))
+            elif options.verbose:
+                msg('%s: %s' % (status, path))
+
+    if options.verbose:
+        msg(', '.join('%u %s' % (counts[status], status) for status in sorted(counts)))
+    return 1 if counts.get('stale') or counts.get('failed') else 0
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%u:%02u:%02u' % (hours, minutes, seconds)
+
+
+def loudness_scan(options):
+    ''' Calculate the loudness of all audio/video files in `options.paths`.
+
+    Files with an up-to-date cached entry are skipped, so an
+    interrupted scan can simply be restarted to resume it.
+    '''
+    import concurrent.futures
+    db = open_loudness_database(options)
+
+    files = [
+        path for path in walk_files(options.paths)
+        if get_media_type(path, sniff=True) in ('audio', 'video')
+    ]
+    db.prefetch(files)
+    todo = [path for path in files if db.check(path) != 'ok']
+    sizes = {path: os.path.getsize(path) for path in todo}
+    total_size = sum(sizes.values())
+    msg('%u files to scan (%u already cached)' % (len(todo), len(files) - len(todo)))
+
+    progress = sys.stderr.isatty()
+    done_size = 0
+    failed = 0
+    start = time.monotonic()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=options.scan_jobs)
+    try:
+        futures = {executor.submit(db.get_loudness, path): path for path in todo}
+        for count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            path = futures[future]
+            try:
+                lufs, peak = future.result()
+                error = None
+            except Exception as e:
+                # E.g. file removed since the scan started: don't abort the whole scan.
+                lufs = None
+                error = e
+            if lufs is None:
+                failed += 1
+                status = 'failed' if error is None else 'failed (%s)' % error
+            else:
+                status = '%.1f LUFS' % lufs
+            # Note: the scan time depends on the duration,
+            # the size is a good enough approximation.
+            done_size += sizes[path]
+            elapsed = time.monotonic() - start
+            eta = elapsed * (total_size - done_size) / done_size if done_size else 0
+            line = '[%u/%u] %.1f%% ETA %s' % (
+                count, len(todo), 100 * done_size / total_size if total_size else 100,
+                format_duration(eta),
+            )
+            if not progress:
+                msg('%s: %s %s' % (status, path, line))
+                continue
+            if lufs is None or options.verbose:
+                msg('\r\033[K%s: %s' % (status, path))
+            print('\r\033[K' + line, end='', file=sys.stderr, flush=True)
+    except KeyboardInterrupt:
+        if progress:
+            msg('')
+        msg('interrupted, run again to resume')
+        return 1
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if progress:
+        msg('')
+    msg('%u files scanned in %s, %u failed' % (
+        len(todo), format_duration(time.monotonic() - start), failed,
+    ))
+    return 1 if failed else 0
+
+
+def loudness_bench(options):
+    ''' Compare the fast and full loudness calculation modes
+    (error and time) on all files in `options.paths`. '''
+    db = open_loudness_database(options)
+    timings = {mode: 0.0 for mode in LoudnessDatabase.MODES}
+    lufs_errors = []
+    peak_errors = []
+    for path in walk_files(options.paths):
+        results = {}
+        for mode in LoudnessDatabase.MODES:
+            start = time.monotonic()
+            results[mode] = db._calculate_loudness(path, mode=mode)
+            results[mode] += (time.monotonic() - start,)
+        full_lufs, full_peak, __, full_time = results['full']
+        fast_lufs, fast_peak, fast_mode, fast_time = results['fast']
+        if full_lufs is None:
+            if options.verbose:
+                msg('skipping %s' % path)
+            continue
+        if fast_mode != 'fast':
+            if options.verbose:
+                msg('skipping %s: too short' % path)
+            continue
+        timings['full'] += full_time
+        timings['fast'] += fast_time
+        lufs_errors.append(fast_lufs - full_lufs)
+        peak_errors.append(fast_peak - full_peak)
+        print('%s: %.2f LUFS %.2f dBTP (%.1fs), fast: %+.2f LU %+.2f dB (%.1fs)' % (
+            path, full_lufs, full_peak, full_time,
+            lufs_errors[-1], peak_errors[-1], fast_time,
+        ))
+    if not lufs_errors:
+        msg('no files to compare')
+        return 1
+    print('%u files, loudness error: mean %.2f LU, max %.2f LU; '
+          'peak error: mean %.2f dB, max %.2f dB; '
+          'time: full %.1fs, fast %.1fs (x%.1f)' % (
+              len(lufs_errors),
+              sum(abs(e) for e in lufs_errors) / len(lufs_errors),
+              max(abs(e) for e in lufs_errors),
+              sum(abs(e) for e in peak_errors) / len(peak_errors),
+              max(abs(e) for e in peak_errors),
+              timings['full'], timings['fast'],
+              timings['full'] / max(timings['fast'], 1e-6),
+          ))
+    return 0
 
 
 class Player:
@@ -86,6 +1138,7 @@ class Player:
     _klasses = {}
 
     _SUBDOWNLOADERS = (
+        'mirror',
         'periscope',
         'subberthehut',
         'subdl',
@@ -97,6 +1150,44 @@ class Player:
         '.sub',
     ))
 
+    _DEFAULT_VOLUME = 35
+    _MAX_VOLUME = 65
+
+    # Arguments to start the player without any file (waiting
+    # for files to be loaded later), None if not supported.
+    _IDLE_ARGS = None
+
+    # Whether the player reports its playlist position
+    # (see `_get_playlist_pos_events`).
+    _REPORTS_PLAYLIST_POS = False
+
+    # Player specific commands.
+    _commands = {}
+
+    # Properties reported by `get_status` and `watch`.
+    _STATUS_PROPERTIES = (
+        'path',
+        'time-pos',
+        'duration',
+        'pause',
+        'volume',
+    )
+
+    # Properties sampled for playback statistics (see `_record_stats`).
+    _STATS_PROPERTIES = (
+        'path',
+        'pause',
+        'video-codec',
+        'hwdec-current',
+        'frame-drop-count',
+        'decoder-frame-drop-count',
+        'vo-delayed-frame-count',
+        'demuxer-cache-duration',
+    )
+
+    # Delay between two playback statistics samples (in seconds).
+    _STATS_INTERVAL = 5
+
     @staticmethod
     def from_name(name, options):
         klass = Player._klasses[name]
@@ -114,86 +1205,136 @@ class Player:
     def __init__(self, options):
         self._options = options
         self._dev_null = open('/dev/null', 'w')
+        self._volume = None
+        self._deferred_volume = False
+        self._per_file_volume = False
+        self._cleanup = []
+        # Killed background processes, not waited for yet (see `finish`).
+        self._killed_pids = []
+        self._streams_db = None
+        # Directory -> (modification time, names of subtitle files).
+        self._subtitles_index = {}
+        self._subtitles_rules = None
+        # Directory -> real path.
+        self._realpaths = {}
 
     @staticmethod
     def _get_input_file(pid):
         return '%s/input-%u' % (MP_DIR, pid)
 
+    def _create_input_file(self):
+        os.mkfifo(self._input_file)
+
+    # Relay commands from the input file (argument) to stdout: block until
+    # a writer shows up, and reopen the FIFO once all writers closed it
+    # (instead of spinning on EOF). The new descriptor is opened before
+    # closing the old one, so the FIFO never lacks a reader (which would
+    # discard what a writer sent in between). See also `mp-relay-test.py`.
+    _RELAY_SCRIPT = textwrap.dedent(
+        '''
+        import os, select, sys
+        poll = select.poll()
+        fd = os.open(sys.argv[1], os.O_RDONLY | os.O_NONBLOCK)
+        while True:
+            poll.register(fd, select.POLLIN)
+            while True:
+                poll.poll()
+                data = os.read(fd, 4096)
+                if not data:
+                    break
+                os.write(sys.stdout.fileno(), data)
+            poll.unregister(fd)
+            old_fd, fd = fd, os.open(sys.argv[1], os.O_RDONLY | os.O_NONBLOCK)
+            os.close(old_fd)
+        ''')
+
     def _get_play_cmd(self):
-        return [
-            sys.executable, '-c',
-            textwrap.dedent(
-                '''
-                import sys
-                input = open(sys.argv[1], "r+")
-                while True:
-                    sys.stdout.write(input.readline())
-                '''),
-            self._input_file,
-        ]
+        return [sys.executable, '-c', self._RELAY_SCRIPT, self._input_file]
 
     def _nvperf(self, mode):
-        from nvperf import nvperf
-        if self._options.debug:
-            dbg('nvperf', mode)
-        nvperf(mode, verbose=self._options.verbose)
+        with TIMINGS.stage('nvperf'):
+            from nvperf import nvperf
+            if self._options.debug:
+                dbg('nvperf', mode)
+            nvperf(mode, verbose=self._options.verbose)
 
     @staticmethod
     def _is_video(fp):
         ''' Check if file is a video file. '''
-        mimetypes.init()
-        mtype, __ = mimetypes.guess_type(fp)
-        if mtype is None:
-            return False
-        return mtype.startswith('video/')
+        return get_media_type(fp, sniff=True) == 'video'
+
+    def _get_real_directory(self, file):
+        ''' Return the real path of the directory containing `file`. '''
+        if os.path.islink(file):
+            return os.path.dirname(os.path.realpath(file))
+        directory = os.path.dirname(os.path.abspath(file))
+        real_directory = self._realpaths.get(directory)
+        if real_directory is None:
+            real_directory = self._realpaths[directory] = os.path.realpath(directory)
+        return real_directory
 
     def _need_subtitles(self, file):
         ''' Do we need subtitles for this file? '''
-        directory = os.path.dirname(os.path.realpath(file))
-        if directory[-1] != '/':
-            directory += '/'
-        for path in self._options.fetch_subtitles:
-            if path[-1] != '/':
-                path += '/'
-            if path[0] == '!' and directory.startswith(path[1:]):
-                return False
-            if directory.startswith(path):
-                return True
-        return False
+        if self._subtitles_rules is None:
+            self._subtitles_rules = PathRules(self._options.fetch_subtitles)
+        return self._subtitles_rules.match(self._get_real_directory(file))
 
     def _has_subtitles(self, file):
         ''' Check if subtitles for the specified file exists. '''
+        import pprint
         # First, check for an external corresponding subtitle file.
         file_name, __ = os.path.splitext(os.path.basename(file))
-        for entry in os.listdir(os.path.dirname(os.path.abspath(file))):
-            name, ext = os.path.splitext(entry)
-            if ext.lower() not in self._SUBEXTS:
-                continue
-            if name.lower() == file_name.lower():
-                return True
-        # Otherwise, use ffprobe to check for embedded subtitle streams.
-        try:
-            info = json.loads(subprocess.run((
-                'ffprobe', '-loglevel', 'warning',
-                '-show_streams', '-print_format', 'json', file,
-            ), stdout=subprocess.PIPE).stdout)
-        except Exception as e:
-            msg(e)
+        if file_name.lower() in self._get_external_subtitles(file):
+            return True
+        # Otherwise, check for embedded subtitle streams.
+        file_streams = self._get_streams_database().get_streams(file)
+        if file_streams is None:
             return False
-        file_streams = info.get('streams', ())
         if self._options.debug:
             dbg('streams', pprint.pformat(file_streams))
         for stream in file_streams:
-            if stream.get('codec_type') != 'subtitle':
+            if stream['codec_type'] != 'subtitle':
                 continue
-            tags = stream.get('tags', {})
-            if self._options.subtitles_language.alpha_3 == (
-                tags.get('language') or tags.get('LANGUAGE')
-            ):
+            if self._options.subtitles_language.alpha_3 == stream['language']:
                 return True
         return False
 
-    def _call_subtitles_downloader(self, cmd):
+    def _get_external_subtitles(self, file):
+        ''' Return the (lowercase) names, without extension, of
+        the subtitle files in the directory of `file`. '''
+        directory = os.path.dirname(os.path.abspath(file))
+        entry = self._subtitles_index.get(directory)
+        if entry is not None:
+            return entry[1]
+        mtime = os.stat(directory).st_mtime_ns
+        names = set()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)
+                if ext.lower() in self._SUBEXTS:
+                    names.add(name.lower())
+        self._subtitles_index[directory] = (mtime, names)
+        return names
+
+    def _refresh_external_subtitles(self, file, force=False):
+        ''' Forget the subtitle files index of the directory of
+        `file` if it was modified (or `force` is true). '''
+        directory = os.path.dirname(os.path.abspath(file))
+        entry = self._subtitles_index.get(directory)
+        if entry is None:
+            return
+        if force or entry[0] != os.stat(directory).st_mtime_ns:
+            del self._subtitles_index[directory]
+
+    def _get_streams_database(self):
+        if self._streams_db is None:
+            self._streams_db = open_streams_database()
+            self._streams_db.prefetch(self._options.files)
+        return self._streams_db
+
+    async def _call_subtitles_downloader(self, cmd, file):
+        import asyncio
+        import subprocess
         if self._options.debug:
             dbg_cmd(cmd)
         if self._options.debug:
@@ -202,23 +1343,56 @@ class Player:
         else:
             stdout = self._dev_null
             stderr = subprocess.STDOUT
+        TIMINGS.count_subprocess(cmd)
         try:
-            return subprocess.call(cmd, stdout=stdout, stderr=stderr)
+            # Note: use a new session, so the downloader
+            # and its children can be killed on cancellation.
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=stdout, stderr=stderr, start_new_session=True,
+            )
         except OSError as e:
             if self._options.debug:
                 dbg('exception', e)
             return -1
+        try:
+            ret = await proc.wait()
+        except asyncio.CancelledError:
+            os.killpg(proc.pid, signal.SIGKILL)
+            await proc.wait()
+            raise
+        # Note: also check the return code, as the directory modification
+        # time granularity may be too coarse to notice the new file.
+        self._refresh_external_subtitles(file, force=ret == 0)
+        return ret
+
+    async def _fetch_subtitles_mirror(self, file):
+        ''' Lookup subtitles in the local mirror directory
+        (as `<hash>.<language>.srt`, or `.sub`). '''
+        import shutil
+        base, __ = os.path.splitext(file)
+        for ext in sorted(self._SUBEXTS):
+            source = os.path.join(self._options.subtitles_mirror, '%s.%s%s' % (
+                self._hashes[file], self._options.subtitles_language.alpha_3, ext,
+            ))
+            if not os.path.exists(source):
+                continue
+            if self._options.debug:
+                dbg('mirror', source)
+            shutil.copyfile(source, base + ext)
+            self._refresh_external_subtitles(file, force=True)
+            return True
+        return False
 
-    def _fetch_subtitles_periscope(self, file):
+    async def _fetch_subtitles_periscope(self, file):
         cmd = [
             'periscope',
             '--language', self._options.subtitles_language.alpha_2,
             '--quiet',
             file,
         ]
-        return self._call_subtitles_downloader(cmd) == 0
+        return await self._call_subtitles_downloader(cmd, file) == 0
 
-    def _fetch_subtitles_subberthehut(self, file):
+    async def _fetch_subtitles_subberthehut(self, file):
         cmd = [
             'subberthehut',
             '--lang', self._options.subtitles_language.alpha_3,
@@ -228,17 +1402,17 @@ class Player:
             '--quiet',
             file,
         ]
-        return self._call_subtitles_downloader(cmd) == 0
+        return await self._call_subtitles_downloader(cmd, file) == 0
 
-    def _fetch_subtitles_subdl(self, file):
+    async def _fetch_subtitles_subdl(self, file):
         cmd = [
             'subdl',
             '--lang', self._options.subtitles_language.alpha_3,
             file,
         ]
-        return self._call_subtitles_downloader(cmd) == 0
+        return await self._call_subtitles_downloader(cmd, file) == 0
 
-    def _fetch_subtitles_subdownloader(self, file):
+    async def _fetch_subtitles_subdownloader(self, file):
         cmd = [
             'subdownloader',
             '--lang', self._options.subtitles_language.alpha_3,
@@ -246,18 +1420,147 @@ class Player:
             '--rename-subs',
             '--cli', '-D',
         ]
-        if self._call_subtitles_downloader(cmd) != 0:
+        import asyncio
+        if await self._call_subtitles_downloader(cmd, file) != 0:
             return False
         # Need to check ourself if subtitles were found since subdownloader
-        # error code does not indicate it.
-        return self._has_subtitles(file)
+        # error code does not indicate it (note: may need to run ffprobe).
+        return await asyncio.get_running_loop().run_in_executor(None, self._has_subtitles, file)
+
+    async def _fetch_subtitles_with(self, downloader, fname, work_file=None):
+        ''' Try fetching subtitles for `fname` with `downloader`
+        (through `work_file`, if specified, see `_race_subtitles_downloaders`). '''
+        import asyncio
+        import shutil
+        async with self._subtitles_semaphores[downloader]:
+            if self._options.debug or self._options.verbose:
+                msg('trying with %s for %s' % (downloader, fname))
+            fn = getattr(self, '_fetch_subtitles_' + downloader)
+            with TIMINGS.stage('subtitles (%s)' % downloader, fname):
+                # Note: the timeout only starts once the downloader is available,
+                # so files queued behind others (see `--subtitles-jobs`) don't time out.
+                try:
+                    found = await asyncio.wait_for(
+                        fn(fname if work_file is None else work_file),
+                        self._options.subtitles_timeout or None,
+                    )
+                except asyncio.TimeoutError:
+                    msg('timeout while fetching subtitles with %s for %s' % (downloader, fname))
+                    return False
+        language = self._options.subtitles_language.alpha_3
+        if found:
+            self._subtitles_misses.clear_misses(self._hashes[fname], language)
+        elif downloader != 'mirror' and shutil.which(downloader) is not None:
+            self._subtitles_misses.add_miss(self._hashes[fname], downloader, language)
+        return found
+
+    def _get_subtitles_downloaders(self, fname):
+        ''' Return the downloaders to try for `fname`
+        (skipping those that recently failed to find subtitles). '''
+        misses = self._subtitles_misses.get_misses(
+            self._hashes[fname], self._options.subtitles_language.alpha_3,
+        )
+        if self._options.subtitles_mirror is None:
+            misses.add('mirror')
+        return [
+            downloader for downloader in self._SUBDOWNLOADERS
+            if downloader not in misses
+        ]
+
+    async def _race_subtitles_downloaders(self, fname):
+        ''' Try all downloaders at once, the first to succeed wins.
+
+        As downloaders save subtitles next to the file (with the same name),
+        each one works on a symbolic link to the file in its own private
+        directory, so the losers (killed when cancelled) cannot overwrite
+        or truncate the subtitles of the winner, which are then moved
+        next to the file.
+        '''
+        import asyncio
+        import shutil
+        import tempfile
+        directory = os.path.dirname(os.path.abspath(fname))
+        try:
+            # Note: in the same directory, so subtitles can be moved atomically.
+            work_directory = tempfile.mkdtemp(prefix='.mp-subtitles-', dir=directory)
+        except OSError as e:
+            msg('cannot race subtitles downloaders for %s: %s' % (fname, e))
+            return await self._try_subtitles_downloaders(fname)
+
+        async def fetch(downloader):
+            work_file = os.path.join(work_directory, downloader, os.path.basename(fname))
+            os.mkdir(os.path.dirname(work_file))
+            os.symlink(os.path.abspath(fname), work_file)
+            self._hashes[work_file] = self._hashes[fname]
+            if await self._fetch_subtitles_with(downloader, fname, work_file):
+                return work_file
+            return None
+
+        tasks = [
+            asyncio.ensure_future(fetch(downloader))
+            for downloader in self._get_subtitles_downloaders(fname)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                work_file = await task
+                if work_file is None:
+                    continue
+                with os.scandir(os.path.dirname(work_file)) as entries:
+                    for entry in entries:
+                        if entry.is_file(follow_symlinks=False):
+                            os.replace(entry.path, os.path.join(directory, entry.name))
+                self._refresh_external_subtitles(fname, force=True)
+                return True
+            return False
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for index in (self._hashes, self._subtitles_index):
+                for path in [p for p in index if p.startswith(work_directory + '/')]:
+                    del index[path]
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    async def _try_subtitles_downloaders(self, fname):
+        ''' Try each downloader in turn, until one succeeds. '''
+        for downloader in self._get_subtitles_downloaders(fname):
+            if await self._fetch_subtitles_with(downloader, fname):
+                return True
+        return False
+
+    async def _fetch_file_subtitles(self, fname):
+
+        if self._options.debug or self._options.verbose:
+            msg('fetching subtitles for %s' % fname)
+
+        if self._options.race_subtitles_downloaders:
+            found = await self._race_subtitles_downloaders(fname)
+        else:
+            found = await self._try_subtitles_downloaders(fname)
+
+        if not found and (self._options.debug or self._options.verbose):
+            msg('no subtitles were found for %s' % fname)
+
+    async def _fetch_files_subtitles(self, files):
+        import asyncio
+        self._subtitles_semaphores = {
+            downloader: asyncio.Semaphore(self._options.subtitles_jobs)
+            for downloader in self._SUBDOWNLOADERS
+        }
+        await asyncio.gather(*(self._fetch_file_subtitles(fname) for fname in files))
 
     def _fetch_subtitles(self):
 
+        import asyncio
         if not self._options.fetch_subtitles:
             return
 
-        mimetypes.init()
+        self._subtitles_misses = open_subtitles_misses(self._options)
+        hash_db = open_hash_database()
+        hash_db.prefetch(self._options.files)
+        self._hashes = {}
+
+        files = []
 
         for fname in self._options.files:
 
@@ -273,84 +1576,482 @@ class Player:
             if self._has_subtitles(fname):
                 continue
 
-            if self._options.debug or self._options.verbose:
-                msg('fetching subtitles for %s' % fname)
-
-            for downloader in self._SUBDOWNLOADERS:
-                if self._options.debug or self._options.verbose:
-                    msg('trying with %s' % downloader)
-                fn = getattr(self, '_fetch_subtitles_' + downloader)
-                if fn(fname):
-                    break
-            else:
+            self._hashes[fname] = hash_db.get_hash(fname)
+            if not self._get_subtitles_downloaders(fname):
                 if self._options.debug or self._options.verbose:
-                    msg('no subtitles were found')
+                    msg('no subtitles were recently found for %s' % fname)
+                continue
+
+            files.append(fname)
+
+        if files:
+            asyncio.run(self._fetch_files_subtitles(files))
 
-    def _calculate_volume(self):
-        database_path = os.path.join(MP_DIR, 'loudness.db')
-        db = LoudnessDatabase(-23, -13)
+    def _calculate_volume(self, files=None):
+        ''' Return the volume for playing `files` (all of them by default). '''
+        db = open_loudness_database(self._options)
+        if files is None:
+            files = self._options.files
+        files = [fname for fname in files if os.path.isfile(fname)]
+        db.prefetch(files)
         min_volume = None
-        for fname in self._options.files:
-            if not os.path.isfile(fname):
-                continue
+        for fname, volume in db.get_volumes(files, jobs=self._options.scan_jobs):
             if self._options.debug or self._options.verbose:
-                msg('calculating volume for %s' % fname)
-            volume = db.get_volume(fname)
+                msg('calculated volume for %s: %s' % (fname, volume))
             if volume is None:
                 continue
             if min_volume is None or min_volume > volume:
                 min_volume = volume
         if min_volume is None:
-            min_volume = 35
+            min_volume = self._DEFAULT_VOLUME
         else:
-            min_volume = min(min_volume, 65)
+            min_volume = min(min_volume, self._MAX_VOLUME)
         volume = int(round(min_volume))
         return volume
 
-    def play(self):
-
-        if not self._options.no_calculate_volume:
-            self._volume = self._calculate_volume()
+    def _calculate_file_volume(self, db, fname):
+        volume = db.get_volume(fname) if os.path.isfile(fname) else None
+        if self._options.debug or self._options.verbose:
+            msg('calculated volume for %s: %s' % (fname, volume))
+        if volume is None:
+            volume = self._DEFAULT_VOLUME
         else:
+            volume = min(volume, self._MAX_VOLUME)
+        return int(round(volume))
+
+    def _get_volume_cmd(self, volume):
+        return 'volume %u' % volume
+
+    def _send_commands(self, cmds, wait=False):
+        for cmd in cmds:
+            self._send_command(cmd, wait=wait)
+
+    def _send_command(self, cmd, wait=False):
+        ''' Send a command to the player through its input file.
+
+        If `wait` is true, wait for the input file to be created and
+        opened by the player, instead of failing immediately.
+        '''
+        while True:
+            try:
+                fd = os.open(self._input_file, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if not wait or e.errno not in (errno.ENOENT, errno.ENXIO):
+                    raise
+                time.sleep(0.1)
+                continue
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(cmd + '\n')
+            return
+
+    def _fork_background(self, fn):
+        ''' Fork a process calling `fn` in the background, and return its PID.
+
+        The process uses its own process group, so it can be killed with
+        all its subprocesses (e.g. loudness scans), see `_kill_background`.
+        '''
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        status = 1
+        try:
+            os.setpgid(0, 0)
+            # Drop the signal handling inherited from the parent (e.g. the daemon
+            # event loop forwarding signals to its wakeup fd), so SIGTERM kills.
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            fn()
+            status = 0
+        except ValueError as e:
+            msg(e)
+        except Exception:
+            # Report it, as `os._exit` would silently discard it.
+            import traceback
+            traceback.print_exc()
+        finally:
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _send_deferred_volume(self):
+        volume = self._calculate_volume()
+        cmd = self._get_volume_cmd(volume)
+        if self._options.debug:
+            dbg('deferred volume', cmd)
+        # Note: the player can exit before opening its input (or before the
+        # volume is calculated), don't wait for it forever in that case.
+        while True:
+            try:
+                self._send_command(cmd)
+                return
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENXIO, errno.ECONNREFUSED):
+                    raise
+            if not self._is_running():
+                return
+            time.sleep(0.1)
+
+    def _is_running(self):
+        ''' Is the player (started by `start`) still running? '''
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def _apply_deferred_volume(self):
+        ''' Fork a process to calculate the volume in the background,
+        and send it to the player once done. '''
+        return self._fork_background(self._send_deferred_volume)
+
+    def _get_playlist_pos_events(self):
+        ''' Return an async iterator over the playlist positions
+        (starting at 0, `None` or -1 when there's no current entry),
+        reported each time the player moves to another entry. '''
+        raise ValueError('playlist position not supported by this player')
+
+    def _prefetch(self, fname):
+        ''' Read ahead the start of `fname`, and warm its metadata cache.
+
+        Stop early if the player moved on, and another file
+        should be read ahead instead.
+        '''
+        size = self._options.read_ahead << 20
+        buf = memoryview(bytearray(min(size, 1 << 20)))
+        try:
+            with open(fname, 'rb', buffering=0) as fp:
+                os.posix_fadvise(fp.fileno(), 0, size, os.POSIX_FADV_WILLNEED)
+                while size > 0:
+                    if fname != self._read_ahead_file:
+                        return
+                    count = fp.readinto(buf[:size])
+                    if not count:
+                        break
+                    size -= count
+            if self._is_video(fname):
+                self._get_streams_database().get_streams(fname)
+        except OSError as e:
+            if self._options.debug:
+                dbg('read ahead failed', e)
+
+    async def _follow_playlist(self):
+        import asyncio
+        import concurrent.futures
+        loop = asyncio.get_running_loop()
+        files = self._options.files
+        read_ahead = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        scan = concurrent.futures.ThreadPoolExecutor(max_workers=self._options.scan_jobs)
+        with read_ahead, scan:
+            volumes = []
+            if self._per_file_volume:
+                # Scanned in playlist order, so each volume
+                # is likely ready by the time its file starts.
+                db = open_loudness_database(self._options)
+                volumes = [loop.run_in_executor(scan, self._calculate_file_volume, db, fname)
+                           for fname in files]
+            async for pos in self._get_playlist_pos_events():
+                # Note: mpv (0.33+) reports -1 when there's no current entry.
+                if pos is None or pos < 0:
+                    continue
+                if self._options.read_ahead and pos + 1 < len(files):
+                    self._read_ahead_file = files[pos + 1]
+                    if self._options.debug:
+                        dbg('read ahead', self._read_ahead_file)
+                    loop.run_in_executor(read_ahead, self._prefetch, self._read_ahead_file)
+                if pos < len(volumes):
+                    try:
+                        volume = await volumes[pos]
+                    except Exception as e:
+                        # E.g. file removed: don't stop following the playlist.
+                        msg('cannot calculate volume for %s: %s' % (files[pos], e))
+                        volume = self._DEFAULT_VOLUME
+                    cmd = self._get_volume_cmd(volume)
+                    if self._options.debug:
+                        dbg('file volume', cmd)
+                    await loop.run_in_executor(None, self._send_command, cmd)
+
+    def _apply_playlist_follower(self):
+        ''' Fork a process following the playlist, to set the volume of
+        each file when it starts, and read ahead the next one. '''
+        import asyncio
+        return self._fork_background(lambda: asyncio.run(self._follow_playlist()))
+
+    def _get_stats_samples(self):
+        ''' Return an async iterator over samples of the playback statistics
+        (dictionaries of `_STATS_PROPERTIES`, with `None` for unavailable ones),
+        taken every `_STATS_INTERVAL` seconds until the player exits. '''
+        raise ValueError('playback statistics not supported by this player')
+
+    @staticmethod
+    def _get_cpu_time(pid):
+        ''' Return the CPU time (user and system, in seconds) used by process `pid`. '''
+        with open('/proc/%u/stat' % pid) as fp:
+            # Note: the command name (2nd field) can contain spaces.
+            fields = fp.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def _log_stats(self, record, cache):
+        if cache:
+            record['cache_min'] = round(min(cache), 1)
+            record['cache_avg'] = round(sum(cache) / len(cache), 1)
+        record['played'] = round(record['played'], 1)
+        record['cpu_time'] = round(record['cpu_time'], 2)
+        if self._options.debug:
+            dbg('stats', record)
+        with open(get_stats_log(), 'a') as fp:
+            fp.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    async def _record_stats(self):
+        import asyncio
+        # Stopped by `finish` (see `_kill_background`): still log the current file.
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        counters = (
+            ('dropped_frames', 'frame-drop-count'),
+            ('decoder_dropped_frames', 'decoder-frame-drop-count'),
+            ('delayed_frames', 'vo-delayed-frame-count'),
+        )
+        record = None
+        # Demuxer cache durations (in seconds) of the current file.
+        cache = []
+        previous = None
+        try:
+            async for sample in self._get_stats_samples():
+                now = time.monotonic()
+                cpu_time = self._get_cpu_time(self.pid)
+                path = sample['path']
+                if path is None:
+                    # Between files.
+                    continue
+                if '://' not in path:
+                    path = os.path.abspath(path)
+                if record is None or path != record['file']:
+                    if record is not None:
+                        self._log_stats(record, cache)
+                    record = {
+                        'time': int(time.time()),
+                        'file': path,
+                        'player': self._options.player,
+                        'profile': self._options.profile,
+                        'nvperf': self._options.use_nvperf,
+                        'codec': None,
+                        'hwdec': None,
+                        'played': 0.0,
+                        'cpu_time': 0.0,
+                        'dropped_frames': 0,
+                        'decoder_dropped_frames': 0,
+                        'delayed_frames': 0,
+                        'cache_min': None,
+                        'cache_avg': None,
+                    }
+                    cache = []
+                    previous = None
+                sample['time'] = now
+                sample['cpu-time'] = cpu_time
+                # Only account for the intervals (partly) spent playing, so
+                # the rates are not diluted by the time spent paused.
+                if previous is not None and not (previous['pause'] and sample['pause']):
+                    record['played'] += now - previous['time']
+                    record['cpu_time'] += cpu_time - previous['cpu-time']
+                    for key, name in counters:
+                        if sample[name] is not None and previous[name] is not None:
+                            # Note: those counters are reset for each file.
+                            record[key] += max(0, sample[name] - previous[name])
+                previous = sample
+                if sample['video-codec'] is not None:
+                    record['codec'] = sample['video-codec']
+                if sample['hwdec-current'] is not None:
+                    record['hwdec'] = sample['hwdec-current']
+                if not sample['pause'] and sample['demuxer-cache-duration'] is not None:
+                    cache.append(sample['demuxer-cache-duration'])
+        except asyncio.CancelledError:
+            pass
+        except FileNotFoundError:
+            # The player exited (see `_get_cpu_time`).
+            pass
+        finally:
+            if record is not None:
+                self._log_stats(record, cache)
+
+    def _apply_stats_recorder(self):
+        ''' Fork a process sampling the playback statistics, and
+        appending them (for each file played) to the statistics log. '''
+        import asyncio
+        return self._fork_background(lambda: asyncio.run(self._record_stats()))
+
+    def _kill_background(self, pid):
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        self._killed_pids.append(pid)
+
+    def prepare(self):
+        ''' Prepare for playing: calculate volume, fetch subtitles. '''
+
+        self._deferred_volume = False
+        self._per_file_volume = False
+        if self._options.per_file_volume and not self._REPORTS_PLAYLIST_POS:
+            msg('per-file volume not supported by this player, using one volume for all files')
+        if self._options.no_calculate_volume:
             self._volume = None
+        elif self._options.per_file_volume and self._REPORTS_PLAYLIST_POS and not self._options.no_play:
+            # Other files are scanned while playing.
+            self._per_file_volume = True
+            if self._options.deferred_volume:
+                self._volume = self._DEFAULT_VOLUME
+            else:
+                with TIMINGS.stage('volume'):
+                    self._volume = self._calculate_volume(self._options.files[:1])
+        elif self._options.deferred_volume and not self._options.no_play:
+            self._volume = self._DEFAULT_VOLUME
+            self._deferred_volume = True
+        else:
+            with TIMINGS.stage('volume'):
+                self._volume = self._calculate_volume()
 
         if not self._options.no_fetch_subtitles:
-            self._fetch_subtitles()
+            with TIMINGS.stage('subtitles'):
+                self._fetch_subtitles()
 
-        if self._options.no_play:
-            return 0
+    def get_warm_key(self):
+        ''' Return the key identifying idle players this one can take over
+        (see `start`), or None if not possible. '''
+        if self._IDLE_ARGS is None or self._options.player_options is not None:
+            return None
+        return (
+            self._options.player,
+            self._options.profile,
+            self._options.use_nvperf,
+            self._options.verbose,
+        )
+
+    def _load_files(self):
+        cmds = []
+        if self._volume is not None:
+            cmds.append(self._get_volume_cmd(self._volume))
+        cmds.extend(self._get_load_cmds(self._options.files))
+        if self._options.debug:
+            for cmd in cmds:
+                dbg('cmd', cmd)
+        self._send_commands(cmds, wait=True)
+
+    def _get_load_cmds(self, files):
+        return [self._get_enqueue_cmd(fname) for fname in files]
+
+    def start(self, idle=False, warm=None):
+        ''' Start the player, and return its PID.
+
+        If `idle` is true, the player is started without any file.
+        If `warm` is an idle player (with the same `get_warm_key`),
+        it is taken over instead of starting a new one, and the files
+        are loaded into it (only then is nvperf applied, if enabled).
+
+        Note: `finish` must be called once the player exits
+        (even if `start` failed).
+        '''
+
+        if warm is not None:
+            mp_pid = warm.pid
+            self._input_file = warm._input_file
+            self._cleanup, warm._cleanup = warm._cleanup, []
+            self._apply_nvperf()
+            self._load_files()
+        else:
+            mp_pid = self._spawn(idle)
 
-        cleanup = []
+        self.pid = mp_pid
+        TIMINGS.mark('until player start')
+        if self._deferred_volume:
+            volume_pid = self._apply_deferred_volume()
+            self._cleanup.append(lambda: self._kill_background(volume_pid))
+        if self._per_file_volume or (self._options.read_ahead and len(self._options.files) > 1):
+            follower_pid = self._apply_playlist_follower()
+            self._cleanup.append(lambda: self._kill_background(follower_pid))
+        if self._options.stats and not idle:
+            stats_pid = self._apply_stats_recorder()
+            self._cleanup.append(lambda: self._kill_background(stats_pid))
 
-        try:
+        return mp_pid
+
+    def _apply_nvperf(self):
+        if self._options.use_nvperf:
+            self._nvperf('+')
+            self._cleanup.append(lambda: self._nvperf('-'))
 
-            if self._options.use_nvperf:
-                self._nvperf('+')
-                cleanup.append(lambda: self._nvperf('-'))
+    def _spawn(self, idle):
 
+        self._cleanup = []
+
+        # Note: not for idle players, see `start`.
+        if not idle:
+            self._apply_nvperf()
+
+        with TIMINGS.stage('fork'):
             mp_pid = os.fork()
-            if mp_pid == 0:
+        if mp_pid == 0:
+
+            try:
 
                 self._input_file = self._get_input_file(os.getpid())
                 if not os.path.exists(MP_DIR):
                     os.mkdir(MP_DIR)
-                os.mkfifo(self._input_file)
+                self._create_input_file()
 
                 cmd = self._get_play_cmd()
                 cmd.insert(1, MP_PROG)
+                if idle:
+                    cmd.extend(self._IDLE_ARGS)
                 if self._options.player_options is not None:
                     cmd.extend(self._options.player_options)
                 cmd.append('--')
-                cmd.extend(self._options.files)
+                if not idle:
+                    cmd.extend(self._options.files)
 
                 if self._options.debug:
                     dbg_cmd(cmd)
 
                 os.execlp(*cmd)
-                sys.exit(1)
 
-            self._input_file = self._get_input_file(mp_pid)
-            cleanup.append(lambda: unlink_if_exists(self._input_file))
+            except Exception as e:
+                msg(e)
+
+            finally:
+                os._exit(1)
+
+        TIMINGS.count_subprocess([self._options.player])
+        self._input_file = self._get_input_file(mp_pid)
+        self._cleanup.append(lambda: unlink_if_exists(self._input_file))
+
+        return mp_pid
+
+    def finish(self, wait=True):
+        ''' Cleanup after the player exited.
+
+        Background processes are killed, and waited for if `wait` is true;
+        otherwise, their PIDs are returned, for the caller to reap them.
+        '''
+        for fn in self._cleanup:
+            fn()
+        self._cleanup = []
+        pids, self._killed_pids = self._killed_pids, []
+        if not wait:
+            return pids
+        for pid in pids:
+            os.waitpid(pid, 0)
+        return []
+
+    def play(self):
+
+        self.prepare()
+
+        if self._options.no_play:
+            return 0
+
+        self._cleanup = []
+
+        try:
+
+            mp_pid = self.start()
             __, status = os.waitpid(mp_pid, 0)
 
             return status >> 8
@@ -359,26 +2060,62 @@ class Player:
             pass
 
         finally:
-            for fn in cleanup:
-                fn()
+            self.finish()
+
+    def _get_command(self, name):
+        return self._commands.get(name, name)
+
+    def _get_enqueue_cmd(self, file):
+        return 'loadfile %s' % json.dumps(file, ensure_ascii=False)
+
+    def get_status(self):
+        ''' Return a dictionary of the player properties (see `_STATUS_PROPERTIES`),
+        with `None` for unavailable ones. '''
+        raise ValueError('status query not supported by this player')
+
+    def get_position(self):
+        ''' Return the current playback position (in seconds). '''
+        return self.get_status()['time-pos']
+
+    def watch(self):
+        ''' Print changes of the player properties, until it exits. '''
+        raise ValueError('watching not supported by this player')
 
     def _get_control_cmd(self):
-        return self._options.cmd
+        return self._get_command(self._options.cmd)
 
     def control(self):
 
-        input_file = self._get_input_file(self._options.pid)
-        if not os.path.exists(input_file):
+        self._input_file = self._get_input_file(self._options.pid)
+        if not os.path.exists(self._input_file):
             msg('no input file for pid %u' % self._options.pid)
             return 1
 
-        cmd = self._get_control_cmd()
+        try:
 
-        if self._options.debug:
-            dbg_cmd(cmd)
+            if self._options.cmd == 'status':
+                status = self.get_status()
+                for name in self._STATUS_PROPERTIES:
+                    print('%s: %s' % (name, status[name]))
+                return 0
+
+            if self._options.cmd == 'watch':
+                self.watch()
+                return 0
 
-        with open(input_file, 'w') as fp:
-            fp.write(cmd + '\n')
+            cmd = self._get_control_cmd()
+
+            if self._options.debug:
+                dbg_cmd(cmd)
+
+            self._send_command(cmd, wait=True)
+
+        except ValueError as e:
+            msg(e)
+            return 1
+
+        except KeyboardInterrupt:
+            pass
 
         return 0
 
@@ -393,6 +2130,10 @@ class MPV(Player):
         'show-progress': 'show_progress',
     }
 
+    _IDLE_ARGS = ('--idle', '--force-window=no')
+
+    _REPORTS_PLAYLIST_POS = True
+
     def _get_play_cmd(self):
         cmd = ['mpv', '--pause']
         if self._options.profile is not None:
@@ -403,15 +2144,257 @@ class MPV(Player):
             cmd.append('-v')
         if self._volume is not None:
             cmd.append('--volume=%u' % self._volume)
-        cmd.append('--input-file=%s' % self._input_file)
+        cmd.append('--input-ipc-server=%s' % self._input_file)
         return cmd
 
-    def _get_control_cmd(self):
-        return self._commands[self._options.cmd]
+    def _create_input_file(self):
+        # Created by mpv itself, make sure there's no stale one.
+        unlink_if_exists(self._input_file)
+
+    def _get_volume_cmd(self, volume):
+        return 'set volume %u' % volume
+
+    def _get_enqueue_cmd(self, file):
+        return 'loadfile %s append-play' % json.dumps(file, ensure_ascii=False)
+
+    def _send_commands(self, cmds, wait=False):
+        commands = [shlex.split(cmd) for cmd in cmds]
+        for result in mpv_commands(self._input_file, commands, wait=wait):
+            if isinstance(result, Exception):
+                raise result
+
+    def _send_command(self, cmd, wait=False):
+        self._send_commands([cmd], wait=wait)
+
+    def _get_load_cmds(self, files):
+        cmds = super()._get_load_cmds(files)
+        # Don't linger once done with the playlist.
+        cmds.append('set idle no')
+        return cmds
+
+    def get_status(self):
+        commands = [('get_property', name) for name in self._STATUS_PROPERTIES]
+        results = mpv_commands(self._input_file, commands)
+        return {
+            name: None if isinstance(value, Exception) else value
+            for name, value in zip(self._STATUS_PROPERTIES, results)
+        }
+
+    async def _get_playlist_pos_events(self):
+        import asyncio
+        queue = asyncio.Queue()
+
+        def on_event(event):
+            if event.get('event') == 'property-change' and event['name'] == 'playlist-pos':
+                queue.put_nowait(event.get('data'))
+
+        client = MPVClient(self._input_file, on_event=on_event)
+        await client.connect(wait=True)
+        try:
+            await client.observe('playlist-pos')
+            closed = asyncio.ensure_future(client.wait_closed())
+            while True:
+                get = asyncio.ensure_future(queue.get())
+                await asyncio.wait((get, closed), return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    break
+                yield get.result()
+        finally:
+            await client.close()
+
+    async def _get_stats_samples(self):
+        import asyncio
+        commands = [('get_property', name) for name in self._STATS_PROPERTIES]
+        client = MPVClient(self._input_file)
+        await client.connect(wait=True)
+        try:
+            closed = asyncio.ensure_future(client.wait_closed())
+            while not closed.done():
+                try:
+                    results = await client.commands(commands)
+                except ConnectionResetError:
+                    break
+                if any(isinstance(value, ConnectionResetError) for value in results):
+                    break
+                yield {
+                    name: None if isinstance(value, Exception) else value
+                    for name, value in zip(self._STATS_PROPERTIES, results)
+                }
+                await asyncio.wait((closed,), timeout=self._STATS_INTERVAL)
+        finally:
+            await client.close()
+
+    async def _watch(self):
+
+        def on_event(event):
+            if event.get('event') == 'property-change':
+                print('%s: %s' % (event['name'], event.get('data')), flush=True)
+
+        client = MPVClient(self._input_file, on_event=on_event)
+        await client.connect()
+        try:
+            await client.observe(*self._STATUS_PROPERTIES)
+            await client.wait_closed()
+        finally:
+            await client.close()
+
+    def watch(self):
+        import asyncio
+        asyncio.run(self._watch())
 
 Player._klasses['mpv'] = MPV
 
 
+def mpv_commands(path, commands, wait=False):
+    ''' Send several commands at once to mpv, and return their results
+    (or exceptions for failed ones) in the same order.
+
+    Blocking version of `MPVClient.commands`, for one-shot uses
+    (not worth setting up an event loop).
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        while True:
+            try:
+                sock.connect(path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if not wait:
+                    raise
+                time.sleep(0.1)
+                continue
+            break
+        sock.sendall(b''.join(
+            json.dumps({'command': list(command), 'request_id': request_id}).encode() + b'\n'
+            for request_id, command in enumerate(commands, 1)
+        ))
+        results = {}
+        with sock.makefile('rb') as fp:
+            while len(results) < len(commands):
+                line = fp.readline()
+                if not line:
+                    raise ConnectionResetError('mpv closed the connection')
+                message = json.loads(line.decode())
+                if 'event' in message or message.get('request_id') not in range(1, len(commands) + 1):
+                    continue
+                if message.get('error') == 'success':
+                    results[message['request_id']] = message.get('data')
+                else:
+                    results[message['request_id']] = ValueError('mpv: %s' % message.get('error'))
+    return [results[request_id] for request_id in range(1, len(commands) + 1)]
+
+
+class MPVClient(object):
+    ''' Client for mpv's JSON IPC protocol (`--input-ipc-server`).
+
+    Replies are matched to their request using `request_id`, so several
+    commands can be in flight at the same time. Events (including the
+    `property-change` events enabled by `observe`) are passed to `on_event`.
+    '''
+
+    def __init__(self, path, on_event=None):
+        self._path = path
+        self._on_event = on_event
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        # Request ID -> future for the reply.
+        self._pending = {}
+        self._request_id = 0
+
+    async def connect(self, wait=False):
+        ''' Connect to mpv.
+
+        If `wait` is true, wait for the socket to be created by mpv,
+        instead of failing immediately.
+        '''
+        import asyncio
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self._path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if not wait:
+                    raise
+                await asyncio.sleep(0.1)
+                continue
+            break
+        self._read_task = asyncio.create_task(self._read_messages())
+
+    async def close(self):
+        import asyncio
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._read_task.cancel()
+        try:
+            await self._read_task
+        except asyncio.CancelledError:
+            pass
+        self._writer = None
+
+    async def wait_closed(self):
+        ''' Wait for mpv to close the connection (e.g. when exiting). '''
+        import asyncio
+        await asyncio.shield(self._read_task)
+
+    async def _read_messages(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                message = json.loads(line.decode())
+                if 'event' in message:
+                    if self._on_event is not None:
+                        self._on_event(message)
+                    continue
+                future = self._pending.pop(message.get('request_id'), None)
+                if future is None or future.done():
+                    continue
+                if message.get('error') == 'success':
+                    future.set_result(message.get('data'))
+                else:
+                    future.set_exception(ValueError('mpv: %s' % message.get('error')))
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError('mpv closed the connection'))
+            self._pending.clear()
+
+    def _send(self, command):
+        import asyncio
+        self._request_id += 1
+        future = asyncio.get_running_loop().create_future()
+        if self._read_task.done():
+            future.set_exception(ConnectionResetError('mpv closed the connection'))
+            return future
+        self._pending[self._request_id] = future
+        request = {'command': list(command), 'request_id': self._request_id}
+        self._writer.write(json.dumps(request).encode() + b'\n')
+        return future
+
+    async def command(self, *command):
+        ''' Send a command, and return its result. '''
+        result, = await self.commands([command])
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def commands(self, commands):
+        ''' Send several commands at once, and return their results
+        (or exceptions for failed ones) in the same order. '''
+        import asyncio
+        futures = [self._send(command) for command in commands]
+        await self._writer.drain()
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    async def observe(self, *names):
+        ''' Subscribe to changes of the specified properties. '''
+        commands = [('observe_property', n, name) for n, name in enumerate(names, 1)]
+        for result in await self.commands(commands):
+            if isinstance(result, Exception):
+                raise result
+
+
 class MPlayer(Player):
 
     _commands = {
@@ -433,15 +2416,621 @@ class MPlayer(Player):
         cmd.extend(['-input', 'file=%s' % self._input_file])
         return cmd
 
-    def _get_control_cmd(self):
-        return self._commands[self._options.cmd]
+    def _get_volume_cmd(self, volume):
+        return 'volume %u 1' % volume
+
+    def _get_enqueue_cmd(self, file):
+        return 'loadfile %s 1' % json.dumps(file, ensure_ascii=False)
 
 Player._klasses['mplayer'] = MPlayer
 
 
+def get_daemon_socket():
+    return os.path.join(MP_DIR, 'daemon.sock')
+
+
+def get_stats_log():
+    return os.path.join(MP_DIR, 'stats.jsonl')
+
+
+class Daemon(object):
+    ''' Long-running process owning players, controlled through a Unix socket.
+
+    Requests and responses are JSON objects, one per line:
+
+    - `{"command": "play", "args": [...], "cwd": "..."}`: start a new player
+      (`args` being `mp-play` arguments), reply with its `pid`
+    - `{"command": "enqueue", "files": [...]}`: append files to a playlist
+    - `{"command": "pause"}`, `{"command": "resume"}`,
+      `{"command": "show-progress"}`: control a player
+    - `{"command": "position"}`: reply with the playback `position`
+    - `{"command": "status"}`: reply with the player `status`
+    - `{"command": "list"}`: reply with the `pids` of all players
+
+    Commands apply to the player with the specified `pid`, or the most
+    recently started one. Errors are replied as `{"error": "..."}`.
+
+    Players are stopped with the daemon.
+    '''
+
+    _CONTROL_COMMANDS = ('pause', 'resume', 'show-progress')
+
+    def __init__(self, options):
+        self._options = options
+        # PID -> player, in start order.
+        self._players = {}
+        # Warm key -> idle player, ready to be taken over by `play`.
+        self._warm_players = {}
+        # Warm key -> profile to respawn an idle player with.
+        self._warm_profiles = {}
+        # PIDs of the killed background processes of finished players.
+        self._background_pids = set()
+
+    def run(self):
+        import asyncio
+        socket_path = get_daemon_socket()
+        try:
+            daemon_request({'command': 'list'})
+        except OSError:
+            pass
+        else:
+            msg('daemon already running')
+            return 1
+        os.makedirs(MP_DIR, exist_ok=True)
+        unlink_if_exists(socket_path)
+        try:
+            asyncio.run(self._serve(socket_path))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            unlink_if_exists(socket_path)
+        return 0
+
+    async def _serve(self, socket_path):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+        loop.add_signal_handler(signal.SIGCHLD, self._reap)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set_result, signum)
+        for profile in self._options.warm_profile or ():
+            self._spawn_warm_player(profile)
+        server = await asyncio.start_unix_server(self._handle_client, path=socket_path)
+        try:
+            async with server:
+                signum = await stopped
+            if self._options.debug:
+                dbg('stopped by signal', signum)
+        finally:
+            loop.remove_signal_handler(signal.SIGCHLD)
+            for players in (self._players, self._warm_players):
+                while players:
+                    __, player = players.popitem()
+                    try:
+                        os.kill(player.pid, signal.SIGTERM)
+                        os.waitpid(player.pid, 0)
+                    except (ProcessLookupError, ChildProcessError):
+                        pass
+                    self._finish_player(player)
+            for pid in self._background_pids:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+
+    def _spawn_warm_player(self, profile):
+        ''' Start an idle player for `profile` (the configured one if empty). '''
+        args = config_args('mp-play')
+        if profile:
+            args.append('--profile=%s' % profile)
+        options = make_parser('mp-play').parse_args(args + ['--', '-'])
+        options.files = []
+        player = Player.from_name(options.player, options)
+        key = player.get_warm_key()
+        if key is None:
+            msg('cannot keep an idle %s player' % options.player)
+            return
+        try:
+            player.start(idle=True)
+        except:
+            self._finish_player(player)
+            raise
+        if self._options.debug:
+            dbg('warm player', '%u %s' % (player.pid, key))
+        self._warm_players[key] = player
+        self._warm_profiles[key] = profile
+
+    def _finish_player(self, player):
+        # Not waiting for the background processes, as
+        # that would block the event loop: see `_reap`.
+        self._background_pids.update(player.finish(wait=False))
+
+    def _reap(self):
+        for pid, player in list(self._players.items()):
+            try:
+                done, __ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done == 0:
+                continue
+            if self._options.debug:
+                dbg('player exited', pid)
+            del self._players[pid]
+            self._finish_player(player)
+        for key, player in list(self._warm_players.items()):
+            try:
+                done, __ = os.waitpid(player.pid, os.WNOHANG)
+            except ChildProcessError:
+                done = player.pid
+            if done == 0:
+                continue
+            # Not respawned, to avoid looping on a broken setup.
+            msg('idle player %u exited' % player.pid)
+            del self._warm_players[key]
+            self._finish_player(player)
+        for pid in list(self._background_pids):
+            try:
+                done, __ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done != 0:
+                self._background_pids.discard(pid)
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode())
+                    if self._options.debug:
+                        dbg('request', request)
+                    response = await self._handle_request(request)
+                except Exception as e:
+                    response = {'error': str(e)}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def _get_player(self, request):
+        pid = request.get('pid')
+        if pid is None:
+            if not self._players:
+                raise ValueError('no player running')
+            pid = list(self._players)[-1]
+        player = self._players.get(pid)
+        if player is None:
+            raise ValueError('no player with pid %u' % pid)
+        return player
+
+    async def _handle_request(self, request):
+        import asyncio
+        command = request.get('command')
+        if command == 'play':
+            return await self._play(request)
+        if command == 'list':
+            return {'pids': list(self._players)}
+        player = self._get_player(request)
+        # Player methods are blocking (and may run their own event loop).
+        call = functools.partial(asyncio.get_running_loop().run_in_executor, None)
+        if command == 'enqueue':
+            for file in request['files']:
+                await call(player._send_command, player._get_enqueue_cmd(file))
+            return {}
+        if command in self._CONTROL_COMMANDS:
+            await call(player._send_command, player._get_command(command))
+            return {}
+        if command == 'position':
+            return {'position': await call(player.get_position)}
+        if command == 'status':
+            return {'status': await call(player.get_status)}
+        raise ValueError('invalid command: %r' % command)
+
+    async def _play(self, request):
+        import asyncio
+        cwd = request.get('cwd', '/')
+        args = config_args('mp-play') + request.get('args', [])
+        try:
+            options = make_parser('mp-play').parse_args(args)
+            directory_args = config_directory_args([os.path.join(cwd, fname) for fname in options.files])
+            if directory_args:
+                args = config_args('mp-play') + directory_args + request.get('args', [])
+                options = make_parser('mp-play').parse_args(args)
+        except SystemExit:
+            raise ValueError('invalid arguments: %s' % ' '.join(args))
+        options.files = [os.path.join(cwd, fname) for fname in options.files]
+        player = Player.from_name(options.player, options)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, player.prepare)
+        if options.no_play:
+            return {}
+        key = player.get_warm_key()
+        warm = self._warm_players.pop(key, None)
+        if warm is not None:
+            if self._options.debug:
+                dbg('using warm player', warm.pid)
+            # Registered right away, so it's reaped even if loading fails.
+            self._players[warm.pid] = player
+            try:
+                await loop.run_in_executor(None, functools.partial(player.start, warm=warm))
+            except:
+                os.kill(warm.pid, signal.SIGTERM)
+                raise
+            finally:
+                loop.call_soon(self._spawn_warm_player, self._warm_profiles[key])
+            return {'pid': warm.pid}
+        try:
+            pid = player.start()
+        except:
+            self._finish_player(player)
+            raise
+        self._players[pid] = player
+        return {'pid': pid}
+
+
+def daemon_request(request):
+    ''' Send a request to the daemon, and return its response. '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(get_daemon_socket())
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        response = sock.makefile('rb').readline()
+    if not response:
+        raise ConnectionResetError('no response from daemon')
+    return json.loads(response.decode())
+
+
+def daemon_client(options):
+    request = {'command': options.action}
+    if options.pid is not None:
+        request['pid'] = options.pid
+    if options.action == 'play':
+        request['args'] = options.args
+        request['cwd'] = os.getcwd()
+    elif options.action == 'enqueue':
+        request['files'] = [os.path.abspath(fname) for fname in options.files]
+    if options.debug:
+        dbg('request', request)
+    try:
+        response = daemon_request(request)
+    except OSError as e:
+        msg('daemon: %s' % e)
+        return 1
+    if 'error' in response:
+        msg(response['error'])
+        return 1
+    if 'pid' in response:
+        print(response['pid'])
+    if 'position' in response:
+        print(response['position'])
+    for name, value in response.get('status', {}).items():
+        print('%s: %s' % (name, value))
+    for pid in response.get('pids', ()):
+        print(pid)
+    return 0
+
+
+# Fields of the playback statistics log entries
+# the report can be aggregated by, see `stats_report`.
+STATS_FIELDS = ('file', 'profile', 'nvperf', 'hwdec', 'codec', 'player')
+
+def stats_report(options):
+    ''' Report the playback statistics logged by `mp-play --stats`,
+    aggregated by `options.group_by` fields. '''
+
+    group_by = options.group_by or ['profile', 'nvperf']
+    rules = PathRules(os.path.abspath(path) for path in options.paths) if options.paths else None
+
+    groups = {}
+    try:
+        with open(get_stats_log()) as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Truncated entry (e.g. disk full).
+                    continue
+                if not record['played']:
+                    continue
+                if rules is not None and not rules.match(os.path.dirname(record['file'])):
+                    continue
+                key = tuple(record.get(field) for field in group_by)
+                groups.setdefault(key, []).append(record)
+    except FileNotFoundError:
+        pass
+    if not groups:
+        msg('no playback statistics (see mp-play --stats)')
+        return 1
+
+    def format_value(field, value):
+        if field == 'nvperf':
+            return 'yes' if value else 'no'
+        return 'none' if value is None else str(value)
+
+    header = list(group_by) + [
+        'plays', 'played', 'dropped/min', 'decoder dropped/min', 'delayed/min', 'CPU', 'min cache',
+    ]
+    rows = []
+    for key in sorted(groups, key=lambda key: [format_value(f, v) for f, v in zip(group_by, key)]):
+        records = groups[key]
+        played = sum(record['played'] for record in records)
+        minutes = played / 60
+        cache = [record['cache_min'] for record in records if record['cache_min'] is not None]
+        rows.append([format_value(field, value) for field, value in zip(group_by, key)] + [
+            '%u' % len(records),
+            format_duration(played),
+            '%.2f' % (sum(record['dropped_frames'] for record in records) / minutes),
+            '%.2f' % (sum(record['decoder_dropped_frames'] for record in records) / minutes),
+            '%.2f' % (sum(record['delayed_frames'] for record in records) / minutes),
+            '%.1f%%' % (100 * sum(record['cpu_time'] for record in records) / played),
+            '%.1fs' % min(cache) if cache else '-',
+        ])
+
+    # Left align the fields, right align the statistics.
+    widths = [max(len(row[n]) for row in [header] + rows) for n in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(
+            value.ljust(width) if n < len(group_by) else value.rjust(width)
+            for n, (value, width) in enumerate(zip(row, widths))
+        ).rstrip())
+    return 0
+
+
+class Inotify(object):
+    ''' Minimal inotify(7) interface. '''
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            self._raise_error()
+        self._watches = {}
+
+    def _raise_error(self, path=None):
+        err = self._ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise_error(path)
+        self._watches[wd] = path
+
+    def read(self):
+        ''' Read pending events.
+
+        Return a list of `(path, mask)` tuples (`path` is `None`
+        for a queue overflow).
+        '''
+        data = os.read(self._fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, __, size = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset+size].rstrip(b'\0')
+            offset += size
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            if mask & self.IN_IGNORED:
+                # Watch was removed (e.g. directory deleted).
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            events.append((os.path.join(directory, os.fsdecode(name)), mask))
+        return events
+
+
+class Indexer(object):
+    ''' Keep the cached information about video files up to date. '''
+
+    # Files are indexed once they have not changed for this long (in seconds).
+    SETTLE_DELAY = 5
+
+    _WATCH_MASK = (
+        Inotify.IN_CLOSE_WRITE |
+        Inotify.IN_MOVED_TO |
+        Inotify.IN_CREATE |
+        Inotify.IN_ONLYDIR
+    )
+
+    def __init__(self, options):
+        self._options = options
+        self._db = open_loudness_database(options)
+        self._streams_db = open_streams_database()
+        self._hash_db = open_hash_database()
+        self._inotify = Inotify()
+        # Files waiting to be indexed: path -> deadline.
+        self._pending = {}
+        # Files being indexed: path -> future.
+        self._running = {}
+
+    def _lower_priority(self):
+        import subprocess
+        os.nice(19)
+        try:
+            cmd = ('ionice', '-c', '3', '-p', str(os.getpid()))
+            TIMINGS.count_subprocess(cmd)
+            subprocess.call(cmd)
+        except OSError as e:
+            msg('ionice: %s' % e)
+
+    def _watch(self, root):
+        ''' Watch the `root` directory tree, and queue all its files. '''
+        directories = [root]
+        while directories:
+            directory = directories.pop()
+            try:
+                self._inotify.add_watch(directory, self._WATCH_MASK)
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                msg(e)
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file():
+                    self._queue(entry.path, delay=0)
+
+    def _queue(self, path, delay=SETTLE_DELAY):
+        if not Player._is_video(path):
+            return
+        self._pending[path] = time.monotonic() + delay
+
+    def _index(self, path):
+        ''' Update the cached information about `path`. '''
+        if self._db.check(path) != 'ok':
+            if self._options.verbose:
+                msg('indexing %s loudness' % path)
+            self._db.get_loudness(path)
+        if self._streams_db.check(path) != 'ok':
+            if self._options.verbose:
+                msg('indexing %s streams' % path)
+            self._streams_db.get_streams(path)
+        if self._hash_db.check(path) != 'ok':
+            self._hash_db.get_hash(path)
+
+    def _reap(self):
+        for path, future in list(self._running.items()):
+            if not future.done():
+                continue
+            del self._running[path]
+            error = future.exception()
+            if isinstance(error, FileNotFoundError):
+                # Already gone.
+                continue
+            if error is not None:
+                msg('%s: %s' % (path, error))
+
+    def _submit(self, executor):
+        ''' Submit settled files for indexing.
+
+        Return the time until the next pending file is settled.
+        '''
+        now = time.monotonic()
+        timeout = None
+        for path, deadline in list(self._pending.items()):
+            if path in self._running:
+                # Wait for the current indexing to finish.
+                continue
+            if deadline > now:
+                delay = deadline - now
+                if timeout is None or delay < timeout:
+                    timeout = delay
+                continue
+            del self._pending[path]
+            self._running[path] = executor.submit(self._index, path)
+        return timeout
+
+    def _handle_events(self):
+        for path, mask in self._inotify.read():
+            if path is None:
+                # Events were lost, rescan everything.
+                for root in self._options.roots:
+                    self._watch(root)
+            elif mask & Inotify.IN_ISDIR:
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    self._watch(path)
+            elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                self._queue(path)
+
+    def run(self):
+        import concurrent.futures
+        self._lower_priority()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._options.scan_jobs)
+        try:
+            for root in self._options.roots:
+                self._watch(root)
+            while True:
+                self._reap()
+                timeout = self._submit(executor)
+                if self._running:
+                    # Poll for finished jobs.
+                    timeout = 1 if timeout is None else min(timeout, 1)
+                ready, __, __ = select.select([self._inotify], [], [], timeout)
+                if ready:
+                    self._handle_events()
+        except KeyboardInterrupt:
+            return 0
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+Language = collections.namedtuple('Language', ('alpha_2', 'alpha_3', 'name'))
+
+# Common languages, so pycountry (and its large
+# databases) is only loaded for the other ones.
+LANGUAGES = tuple(Language(*fields) for fields in (
+    ('ar', 'ara', 'Arabic'),
+    ('bg', 'bul', 'Bulgarian'),
+    ('ca', 'cat', 'Catalan'),
+    ('cs', 'ces', 'Czech'),
+    ('da', 'dan', 'Danish'),
+    ('de', 'deu', 'German'),
+    ('el', 'ell', 'Modern Greek (1453-)'),
+    ('en', 'eng', 'English'),
+    ('es', 'spa', 'Spanish'),
+    ('et', 'est', 'Estonian'),
+    ('fa', 'fas', 'Persian'),
+    ('fi', 'fin', 'Finnish'),
+    ('fr', 'fra', 'French'),
+    ('he', 'heb', 'Hebrew'),
+    ('hi', 'hin', 'Hindi'),
+    ('hr', 'hrv', 'Croatian'),
+    ('hu', 'hun', 'Hungarian'),
+    ('id', 'ind', 'Indonesian'),
+    ('it', 'ita', 'Italian'),
+    ('ja', 'jpn', 'Japanese'),
+    ('ko', 'kor', 'Korean'),
+    ('lt', 'lit', 'Lithuanian'),
+    ('lv', 'lav', 'Latvian'),
+    ('ms', 'msa', 'Malay (macrolanguage)'),
+    ('nl', 'nld', 'Dutch'),
+    ('no', 'nor', 'Norwegian'),
+    ('pl', 'pol', 'Polish'),
+    ('pt', 'por', 'Portuguese'),
+    ('ro', 'ron', 'Romanian'),
+    ('ru', 'rus', 'Russian'),
+    ('sk', 'slk', 'Slovak'),
+    ('sl', 'slv', 'Slovenian'),
+    ('sr', 'srp', 'Serbian'),
+    ('sv', 'swe', 'Swedish'),
+    ('th', 'tha', 'Thai'),
+    ('tr', 'tur', 'Turkish'),
+    ('uk', 'ukr', 'Ukrainian'),
+    ('vi', 'vie', 'Vietnamese'),
+    ('zh', 'zho', 'Chinese'),
+))
+
+
 def language(v):
-    if isinstance(v, languages.data_class_base):
+    if not isinstance(v, str):
         return v
+    for k in 'name alpha_3 alpha_2'.split():
+        for r in LANGUAGES:
+            if getattr(r, k) == v:
+                return r
+    with TIMINGS.stage('import pycountry'):
+        from pycountry import languages
     for k in 'name alpha_3 alpha_2'.split():
         try:
             r = languages.get(**{k: v})
@@ -453,78 +3042,292 @@ def language(v):
     raise ValueError('invalid language: %r' % v)
 
 
-parser = argparse.ArgumentParser(prog=MP_PROG)
+def add_loudness_arguments(parser):
+    parser.add_argument('--loudness-mode',
+                        choices=LoudnessDatabase.MODES, default='full',
+                        help='full scan, or fast (approximate) scan of sampled windows')
+    parser.add_argument('--loudness-windows',
+                        metavar='N', type=int, default=10,
+                        help='number of windows decoded per file in fast loudness mode')
+    parser.add_argument('--scan-jobs',
+                        metavar='N', type=int, default=os.cpu_count() or 1,
+                        help='number of files to scan for loudness in parallel')
 
-parser.add_argument('-d', '--debug',
-                    action='store_true', default=False,
-                    help='enable debug traces')
 
-if MP_PROG == 'mp-play':
+def make_parser(prog):
+    ''' Create the arguments parser for program mode `prog`,
+    return `None` for an invalid mode. '''
 
-    parser.add_argument('-p', '--player',
-                        choices=list(Player._klasses.keys()), default='mpv',
-                        help='select player to use')
-    parser.add_argument('--fetch-subtitles',
-                        metavar='LOCATION', action='append', default=[],
-                        help='automatically fetch subtitles for files in the specified location')
-    parser.add_argument('--no-fetch-subtitles',
-                        action='store_true', default=False,
-                        help='disable automatically fetching subtitles')
-    parser.add_argument('--no-calculate-volume',
-                        action='store_true', default=False,
-                        help='disable appropriate volume calculation')
-    parser.add_argument('--no-play',
-                        action='store_true', default=False,
-                        help='do not play video')
-    parser.add_argument('--subtitles-language',
-                        metavar='LANGUAGE', default='en', type=language,
-                        help='language to use when fetching subtitles')
-    parser.add_argument('--use-nvperf',
-                        action='store_true', default=False,
-                        help='use nvperf to switch to maximum performance during play')
-    parser.add_argument('--option',
-                        metavar='OPTION', action='append', dest='player_options',
-                        help='add an option to be passed to the underlying player')
-    parser.add_argument('--profile',
-                        help='select the specified configuration profile')
-    parser.add_argument('-v', '--verbose',
-                        action='store_true', default=False,
-                        help='enable verbose mode')
-
-    parser.add_argument('files', nargs='+')
-
-elif MP_PROG == 'mp-control':
-
-    parser.add_argument('pid', type=int, help='PID of the player to control')
-    parser.add_argument('cmd', choices=['pause', 'resume', 'show-progress'],
-                        help='command to send to player')
-
-else:
-    print('invalid mode: %s' % MP_PROG, file=sys.stderr)
-    sys.exit(1)
-
-
-args = []
-
-config_file = '%s/config' % MP_DIR
-if os.path.exists(config_file):
+    parser = argparse.ArgumentParser(prog=prog)
 
+    parser.add_argument('-d', '--debug',
+                        action='store_true', default=False,
+                        help='enable debug traces')
+
+    if prog == 'mp-play':
+
+        parser.add_argument('-p', '--player',
+                            choices=list(Player._klasses.keys()), default='mpv',
+                            help='select player to use')
+        parser.add_argument('--deferred-volume',
+                            action='store_true', default=False,
+                            help='start playing immediately, and set the appropriate volume once calculated')
+        parser.add_argument('--fetch-subtitles',
+                            metavar='LOCATION', action='append', default=[],
+                            help='automatically fetch subtitles for files in the specified location '
+                            '(or not, if prefixed by "!"; the most specific location applies)')
+        add_loudness_arguments(parser)
+        parser.add_argument('--no-fetch-subtitles',
+                            action='store_true', default=False,
+                            help='disable automatically fetching subtitles')
+        parser.add_argument('--no-calculate-volume',
+                            action='store_true', default=False,
+                            help='disable appropriate volume calculation')
+        parser.add_argument('--no-play',
+                            action='store_true', default=False,
+                            help='do not play video')
+        parser.add_argument('--per-file-volume',
+                            action='store_true', default=False,
+                            help='set the appropriate volume of each file when it starts playing, '
+                            'instead of one volume for all files')
+        parser.add_argument('--race-subtitles-downloaders',
+                            action='store_true', default=False,
+                            help='try all subtitles downloaders at once, instead of one after the other')
+        parser.add_argument('--read-ahead',
+                            type=int, metavar='MIB', default=0,
+                            help='while playing a file, read ahead up to MIB MiB of the next one '
+                            '(default: disabled)')
+        parser.add_argument('--stats',
+                            action='store_true', default=False,
+                            help='sample playback statistics (dropped frames, hardware decoding, cache, CPU usage) '
+                            'and log them for each file played (see mp-stats)')
+        parser.add_argument('--subtitles-jobs',
+                            metavar='N', type=int, default=4,
+                            help='number of files to fetch subtitles for in parallel (per downloader)')
+        parser.add_argument('--subtitles-language',
+                            metavar='LANGUAGE', default='en', type=language,
+                            help='language to use when fetching subtitles')
+        parser.add_argument('--subtitles-mirror',
+                            metavar='DIRECTORY',
+                            help='lookup subtitles in the specified directory first (as <hash>.<language>.srt)')
+        parser.add_argument('--subtitles-retry-backoff',
+                            metavar='FACTOR', type=float, default=2,
+                            help='multiply the delay before retrying by this factor after each new failure')
+        parser.add_argument('--subtitles-retry-delay',
+                            metavar='HOURS', type=float, default=24,
+                            help='delay before retrying a subtitles downloader that found nothing for a file')
+        parser.add_argument('--subtitles-timeout',
+                            metavar='SECONDS', type=float, default=120,
+                            help='maximum time spent fetching subtitles for a file with each downloader, '
+                            'not counting the time waiting for a free job (0 for no limit)')
+        parser.add_argument('--timings',
+                            action='store_true', default=False,
+                            help='print a summary of the time spent in each stage at exit')
+        parser.add_argument('--timings-file',
+                            metavar='FILE',
+                            help='append the detailed timings (including per file ones) '
+                            'to FILE, as JSON')
+        parser.add_argument('--use-nvperf',
+                            action='store_true', default=False,
+                            help='use nvperf to switch to maximum performance during play')
+        parser.add_argument('--option',
+                            metavar='OPTION', action='append', dest='player_options',
+                            help='add an option to be passed to the underlying player')
+        parser.add_argument('--profile',
+                            help='select the specified configuration profile')
+        parser.add_argument('-v', '--verbose',
+                            action='store_true', default=False,
+                            help='enable verbose mode')
+
+        parser.add_argument('files', nargs='+')
+
+    elif prog == 'mp-control':
+
+        parser.add_argument('pid', type=int, help='PID of the player to control')
+        parser.add_argument('cmd', choices=['pause', 'resume', 'show-progress', 'status', 'watch'],
+                            help='command to send to player, or status query')
+
+    elif prog == 'mp-loudness':
+
+        add_loudness_arguments(parser)
+        parser.add_argument('-v', '--verbose',
+                            action='store_true', default=False,
+                            help='enable verbose mode')
+
+        subparsers = parser.add_subparsers(dest='action', metavar='ACTION')
+        subparsers.required = True
+
+        verify_parser = subparsers.add_parser('verify', help='check for stale cached loudness entries')
+        verify_parser.add_argument('--repair',
+                                   action='store_true', default=False,
+                                   help='rescan files with a stale (or approximate) entry')
+        verify_parser.add_argument('paths', nargs='+', metavar='PATH')
+
+        bench_parser = subparsers.add_parser('bench', help='compare fast and full loudness modes')
+        bench_parser.add_argument('paths', nargs='+', metavar='PATH')
+
+        scan_parser = subparsers.add_parser('scan', help='calculate (and cache) the loudness of '
+                                            'all audio/video files not cached yet')
+        scan_parser.add_argument('paths', nargs='+', metavar='PATH')
+
+    elif prog == 'mp-indexer':
+
+        add_loudness_arguments(parser)
+        parser.add_argument('--root',
+                            metavar='DIRECTORY', action='append', dest='roots', default=[],
+                            help='index (and watch for changes) files in the specified location')
+        parser.add_argument('-v', '--verbose',
+                            action='store_true', default=False,
+                            help='enable verbose mode')
+
+    elif prog == 'mp-daemon':
+
+        parser.add_argument('--pid',
+                            type=int,
+                            help='PID of the player to control (default to the most recent one)')
+
+        subparsers = parser.add_subparsers(dest='action', metavar='ACTION')
+        subparsers.required = True
+
+        serve_parser = subparsers.add_parser('serve', help='run the daemon')
+        serve_parser.add_argument('--warm-profile',
+                                  action='append', metavar='PROFILE',
+                                  help='keep an idle player started with this profile (empty for the configured one), '
+                                  'to be used for playing new files (can be repeated)')
+        play_parser = subparsers.add_parser('play', help='start playing files')
+        play_parser.add_argument('args', nargs=argparse.REMAINDER, metavar='ARGS',
+                                 help='mp-play arguments')
+        enqueue_parser = subparsers.add_parser('enqueue', help='add files to the playlist')
+        enqueue_parser.add_argument('files', nargs='+', metavar='FILE')
+        for action in Daemon._CONTROL_COMMANDS:
+            subparsers.add_parser(action, help='send command to player')
+        subparsers.add_parser('position', help='query the playback position')
+        subparsers.add_parser('status', help='query the player status')
+        subparsers.add_parser('list', help='list running players')
+
+    elif prog == 'mp-stats':
+
+        parser.add_argument('-g', '--group-by',
+                            metavar='FIELD', action='append', choices=STATS_FIELDS,
+                            help='aggregate the playback statistics by FIELD (one of: %s; can be repeated, '
+                            'default: profile and nvperf)' % ', '.join(STATS_FIELDS))
+        parser.add_argument('paths', nargs='*', metavar='PATH',
+                            help='only report files in the specified locations')
+
+    else:
+        return None
+
+    return parser
+
+
+def load_config():
+    ''' Return the configuration, as a mapping of section name to arguments.
+
+    Parsing the configuration file is cached in `MP_DIR/config.cache`,
+    invalidated when the configuration file changes.
+    '''
+
+    config_file = '%s/config' % MP_DIR
+    cache_file = '%s/config.cache' % MP_DIR
+
+    try:
+        st = os.stat(config_file)
+    except FileNotFoundError:
+        return {}
+    stamp = [st.st_mtime_ns, st.st_size]
+
+    try:
+        with open(cache_file) as fp:
+            cache = json.load(fp)
+        if cache['stamp'] == stamp:
+            return cache['sections']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    import configparser
     config = configparser.RawConfigParser(allow_no_value=True)
     config.read(config_file)
 
-    for section in ('default', MP_PROG):
-        if config.has_section(section):
-            for k, v in config.items(section):
-                opt_name = '--' + k
-                if v is None:
-                    args.append(opt_name)
-                    continue
-                for opt_val in shlex.split(v, comments=True):
-                    args.append('%s=%s' % (opt_name, opt_val))
+    sections = {}
+    for section in config.sections():
+        args = sections[section] = []
+        for k, v in config.items(section):
+            opt_name = '--' + k
+            if v is None:
+                args.append(opt_name)
+                continue
+            for opt_val in shlex.split(v, comments=True):
+                args.append('%s=%s' % (opt_name, opt_val))
+
+    tmp_file = '%s.%u' % (cache_file, os.getpid())
+    try:
+        with open(tmp_file, 'w') as fp:
+            json.dump({'stamp': stamp, 'sections': sections}, fp, separators=(',', ':'))
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_file)
+
+    return sections
+
+def config_args(prog):
+    ''' Return the arguments for program mode `prog` from the configuration file. '''
+
+    sections = load_config()
+    args = []
+    for section in ('default', prog):
+        args.extend(sections.get(section, ()))
+
+    return args
+
+def config_directory_args(files):
+    ''' Return the arguments from the configuration file for the directory of the first of `files`.
+
+    Directory sections (e.g. `[/media/anime]`) apply to their whole
+    tree, the most specific one winning.
+    '''
+
+    directories = {s.rstrip('/') or '/': args for s, args in load_config().items() if s.startswith('/')}
+    if not files or not directories:
+        return []
+
+    path = os.path.dirname(os.path.realpath(files[0]))
+    while True:
+        args = directories.get(path)
+        if args is not None:
+            return list(args)
+        if path == '/':
+            return []
+        path = os.path.dirname(path)
+
+
+with TIMINGS.stage('arguments'):
+    parser = make_parser(MP_PROG)
+if parser is None:
+    print('invalid mode: %s' % MP_PROG, file=sys.stderr)
+    sys.exit(1)
 
+with TIMINGS.stage('config'):
+    args = config_args(MP_PROG)
 args.extend(sys.argv[1:])
 
-options = parser.parse_args(args)
+if MP_PROG == 'mp-daemon':
+    # Options for the player are passed through to the daemon.
+    options, extra_args = parser.parse_known_args(args)
+    if extra_args and options.action != 'play':
+        parser.error('unrecognized arguments: %s' % ' '.join(extra_args))
+    if options.action == 'play':
+        options.args = extra_args + options.args
+else:
+    with TIMINGS.stage('arguments'):
+        options = parser.parse_args(args)
+    if MP_PROG == 'mp-play':
+        with TIMINGS.stage('config'):
+            directory_args = config_directory_args(options.files)
+        if directory_args:
+            # Directory overrides go between the configured and command line arguments.
+            args = config_args(MP_PROG) + directory_args + sys.argv[1:]
+            options = parser.parse_args(args)
 
 if options.debug:
     dbg('args', args)
@@ -533,8 +3336,28 @@ if options.debug:
 if MP_PROG == 'mp-play':
     player = Player.from_name(options.player, options)
     ret = player.play()
+    if options.timings or options.timings_file is not None:
+        TIMINGS.report(options.timings_file)
 elif MP_PROG == 'mp-control':
     player = Player.from_pid(options.pid, options)
     ret = player.control()
+elif MP_PROG == 'mp-loudness':
+    if options.action == 'verify':
+        ret = loudness_verify(options)
+    elif options.action == 'bench':
+        ret = loudness_bench(options)
+    elif options.action == 'scan':
+        ret = loudness_scan(options)
+elif MP_PROG == 'mp-indexer':
+    if not options.roots:
+        parser.error('no location to index')
+    ret = Indexer(options).run()
+elif MP_PROG == 'mp-stats':
+    ret = stats_report(options)
+elif MP_PROG == 'mp-daemon':
+    if options.action == 'serve':
+        ret = Daemon(options).run()
+    else:
+        ret = daemon_client(options)
 
 sys.exit(ret)